@@ -8,32 +8,82 @@ from db import REDIS_URL
 
 
 from dotenv import load_dotenv
+from ratelimit import RateLimitMiddleware
 
 
-from db import init_db
+from migrations import migrate
 from handlers import register_handlers
-from tasks import check_expired_posts
-from middleware import AntiSpamMiddleware
+from middleware import AntiSpamMiddleware, DbSessionMiddleware, MetricsMiddleware
+from metrics import start_metrics_server
+from cache import listen_invalidations
+from outbound import outbound
+from webhook import run_webhook, WEBHOOK_HOST, WEBHOOK_PORT
+from payments import run_payment_server
+from streams import StreamIngestMiddleware
+from services_payment import close_session
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# polling - long polling, webhook - aiohttp-сервер (см. webhook.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# local - апдейты обрабатывает этот процесс, stream - только кладёт их в Redis Streams для bot_worker.py
+UPDATE_MODE = os.getenv("UPDATE_MODE", "local")
+# При polling уведомления ЮKassa принимает отдельный сервер на WEBHOOK_PORT
+PAYMENT_NOTIFICATIONS = os.getenv("PAYMENT_NOTIFICATIONS", "1") == "1"
 
 storage = RedisStorage.from_url(REDIS_URL)
 
 bot = Bot(token=BOT_TOKEN)
+bot.session.middleware(RateLimitMiddleware())
 dp = Dispatcher(storage=storage)
-anti_spam = AntiSpamMiddleware(min_interval=1.0, max_violations=3, ban_time=10)
+# Лимиты настраиваются отдельно для сообщений и нажатий кнопок
+message_anti_spam = AntiSpamMiddleware(
+    kind="message",
+    min_interval=float(os.getenv("SPAM_MESSAGE_INTERVAL", 1.0)),
+    max_violations=int(os.getenv("SPAM_MESSAGE_VIOLATIONS", 3)),
+    ban_time=int(os.getenv("SPAM_MESSAGE_BAN", 10))
+)
+callback_anti_spam = AntiSpamMiddleware(
+    kind="callback",
+    min_interval=float(os.getenv("SPAM_CALLBACK_INTERVAL", 1.0)),
+    max_violations=int(os.getenv("SPAM_CALLBACK_VIOLATIONS", 3)),
+    ban_time=int(os.getenv("SPAM_CALLBACK_BAN", 10))
+)
 
-dp.message.middleware(anti_spam)
-dp.callback_query.middleware(anti_spam)
 
-async def main():
-    await init_db()
+def setup_dispatcher(ingest: bool = False):
+    """Подключает middleware и роутеры. При ingest=True апдейты дальше потока не идут,
+    но роутеры всё равно нужны, чтобы знать allowed_updates"""
+    if ingest:
+        dp.update.outer_middleware(StreamIngestMiddleware())
+    else:
+        dp.update.outer_middleware(DbSessionMiddleware())
+        dp.message.middleware(message_anti_spam)
+        dp.callback_query.middleware(callback_anti_spam)
+        # Колбэки замеряет CallbackRegistry, там известен настоящий хэндлер
+        dp.message.middleware(MetricsMiddleware())
     register_handlers(dp)
-    asyncio.create_task(check_expired_posts(bot))
-    await dp.start_polling(bot)
+    dp.shutdown.register(close_session)
+
+
+async def main():
+    await migrate()
+    start_metrics_server()
+    setup_dispatcher(ingest=UPDATE_MODE == "stream")
+    asyncio.create_task(listen_invalidations())
+    outbound.start()
+    if BOT_MODE == "webhook":
+        await run_webhook(dp, bot)
+    else:
+        if PAYMENT_NOTIFICATIONS:
+            asyncio.create_task(run_payment_server(bot, WEBHOOK_HOST, WEBHOOK_PORT))
+        # Пока установлен вебхук, getUpdates не работает
+        await bot.delete_webhook()
+        # В режиме stream апдейты пачки кладутся в потоки по очереди из одной задачи,
+        # иначе два апдейта пользователя могли бы попасть в партицию в обратном порядке
+        await dp.start_polling(bot, handle_as_tasks=UPDATE_MODE != "stream")
 
 try:
     if __name__ == "__main__":
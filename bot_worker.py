@@ -0,0 +1,30 @@
+# bot_worker.py
+import asyncio
+import logging
+
+from bot import bot, dp, setup_dispatcher
+from cache import listen_invalidations
+from metrics import start_metrics_server
+from outbound import outbound
+from streams import UpdateConsumer
+
+logging.basicConfig(level=logging.INFO)
+
+
+async def main():
+    """Обработчик апдейтов из Redis Streams (UPDATE_MODE=stream в bot.py).
+    Процессов может быть сколько угодно, партиции делятся между ними сами"""
+    start_metrics_server()
+    setup_dispatcher()
+    asyncio.create_task(listen_invalidations())
+    outbound.start()
+    await dp.emit_startup(bot=bot)
+    try:
+        await UpdateConsumer(dp, bot).run()
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,280 @@
+# broadcast.py
+import asyncio
+import logging
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from sqlalchemy import func, select, update
+
+from db import async_session, redis_client, Draft, User
+from jobs import job, enqueue, Retry
+from metrics import BROADCAST_MESSAGES
+from ratelimit import LocalBucket
+from cache import redis_lease
+
+# Рассылка идёт слайсами: задача работает не дольше BROADCAST_SLICE секунд,
+# сохраняет позицию в Redis и ставит в очередь продолжение. Упавший воркер
+# теряет не больше текущей страницы, а отправленные из неё получатели
+# помечены в Redis и повторно сообщение не получат
+BROADCAST_PAGE = int(os.getenv("BROADCAST_PAGE", 200))
+BROADCAST_SLICE = int(os.getenv("BROADCAST_SLICE", 60))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20))
+# Ниже глобального лимита Telegram (TG_GLOBAL_RATE), чтобы ответы пользователям не стояли в очереди
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_TTL = 7 * 24 * 60 * 60
+
+# Предупреждение владельцу поста за EXPIRY_WARNING секунд до снятия
+EXPIRY_WARNING = int(os.getenv("EXPIRY_WARNING", 24 * 60 * 60))
+EXPIRY_WARNING_INTERVAL = int(os.getenv("EXPIRY_WARNING_INTERVAL", 60 * 60))
+
+
+def broadcast_key(broadcast_id: str) -> str:
+    return f"broadcast:{broadcast_id}"
+
+
+async def deliver(bot, chat_id: int, text: str, parse_mode: str | None = None) -> str:
+    """Отправляет одно сообщение. Возвращает "sent", "blocked" или "failed"""
+    for _ in range(3):
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode,
+                                   disable_web_page_preview=True)
+            return "sent"
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramBadRequest as e:
+            if "chat not found" in str(e):
+                return "blocked"
+            logging.warning(f"Рассылка: не удалось отправить {chat_id}: {e}")
+            return "failed"
+        except Exception as e:
+            logging.warning(f"Рассылка: не удалось отправить {chat_id}: {e}")
+            return "failed"
+    return "failed"
+
+
+async def mark_blocked(telegram_ids):
+    """Следующие рассылки пропускают этих пользователей; /start снимает отметку"""
+    if not telegram_ids:
+        return
+    async with async_session() as session:
+        await session.execute(
+            update(User).where(User.telegram_id.in_(telegram_ids)).values(is_blocked=True)
+        )
+        await session.commit()
+
+
+async def send_many(bot, recipients, text: str, parse_mode: str | None = None, on_sent=None) -> dict:
+    """Отправляет text получателям [(telegram_id, ...)] параллельно, не быстрее BROADCAST_RATE.
+    Возвращает {"sent": n, "blocked": n, "failed": n}"""
+    bucket = LocalBucket(BROADCAST_RATE, max(1, int(BROADCAST_RATE)))
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    counts = {"sent": 0, "blocked": 0, "failed": 0}
+    blocked = []
+
+    async def send(telegram_id: int):
+        async with semaphore:
+            while (wait := bucket.wait_time()) > 0:
+                await asyncio.sleep(wait)
+            bucket.consume()
+            result = await deliver(bot, telegram_id, text, parse_mode)
+        counts[result] += 1
+        BROADCAST_MESSAGES.labels(result).inc()
+        if result == "blocked":
+            blocked.append(telegram_id)
+        elif result == "sent" and on_sent:
+            await on_sent(telegram_id)
+
+    await asyncio.gather(*(send(row[0]) for row in recipients))
+    await mark_blocked(blocked)
+    return counts
+
+
+async def start_broadcast(text: str, parse_mode: str | None = None) -> str:
+    """Создаёт рассылку всем незаблокированным пользователям и ставит её в очередь"""
+    async with async_session() as session:
+        total = (await session.execute(
+            select(func.count()).select_from(User).where(User.is_blocked == False)
+        )).scalar()
+    broadcast_id = uuid.uuid4().hex[:12]
+    key = broadcast_key(broadcast_id)
+    await redis_client.hset(key, mapping={
+        "text": text,
+        "parse_mode": parse_mode or "",
+        "status": "running",
+        "last_id": 0,
+        "total": total,
+        "processed": 0,
+        "sent": 0,
+        "blocked": 0,
+        "failed": 0,
+        "started_at": time.time(),
+    })
+    await redis_client.expire(key, BROADCAST_TTL)
+    await enqueue("broadcast", key=f"broadcast:{broadcast_id}:0", broadcast_id=broadcast_id)
+    logging.info(f"Рассылка {broadcast_id} запущена на {total} получателей")
+    return broadcast_id
+
+
+async def broadcast_status(broadcast_id: str) -> dict | None:
+    """Прогресс рассылки: счётчики, скорость (сообщений/с) и оценка оставшегося времени (с)"""
+    raw = await redis_client.hgetall(broadcast_key(broadcast_id))
+    if not raw:
+        return None
+    state = {k.decode(): v.decode() for k, v in raw.items()}
+    processed = int(state["processed"])
+    total = int(state["total"])
+    elapsed = (float(state.get("finished_at") or time.time())) - float(state["started_at"])
+    rate = processed / elapsed if elapsed > 0 else 0
+    return {
+        "id": broadcast_id,
+        "status": state["status"],
+        "total": total,
+        "processed": processed,
+        "sent": int(state["sent"]),
+        "blocked": int(state["blocked"]),
+        "failed": int(state["failed"]),
+        "rate": round(rate, 1),
+        "eta": round(max(total - processed, 0) / rate) if rate else None,
+    }
+
+
+@job("broadcast", max_retries=10)
+async def job_broadcast(bot, broadcast_id: str):
+    key = broadcast_key(broadcast_id)
+    # Один слайс рассылки за раз, даже если задачу подобрал второй воркер. Слайс может
+    # затянуться на целую страницу, поэтому аренда продлевается и снимается только своя
+    async with redis_lease(key, BROADCAST_SLICE * 2000, keepalive=True) as acquired:
+        if not acquired:
+            raise Retry(f"рассылка {broadcast_id} уже выполняется", delay=BROADCAST_SLICE)
+        state = await redis_client.hgetall(key)
+        if not state or state[b"status"] != b"running":
+            return
+        text = state[b"text"].decode()
+        parse_mode = state[b"parse_mode"].decode() or None
+        last_id = int(state[b"last_id"])
+        # Получатели текущей страницы, которым уже отправлено до падения воркера
+        page_sent = f"{key}:page"
+        deadline = time.monotonic() + BROADCAST_SLICE
+
+        # Хотя бы одна страница за слайс, иначе рассылка не двигается
+        while True:
+            async with async_session() as session:
+                result = await session.execute(
+                    select(User.telegram_id, User.id)
+                    .where(User.id > last_id, User.is_blocked == False)
+                    .order_by(User.id)
+                    .limit(BROADCAST_PAGE)
+                )
+                rows = result.all()
+            if not rows:
+                await redis_client.hset(key, mapping={"status": "done", "finished_at": time.time()})
+                await redis_client.delete(page_sent)
+                logging.info(f"Рассылка {broadcast_id} завершена: {await broadcast_status(broadcast_id)}")
+                return
+
+            already = {int(x) for x in await redis_client.smembers(page_sent)}
+            pending = [row for row in rows if row.telegram_id not in already]
+
+            async def remember(telegram_id: int):
+                await redis_client.sadd(page_sent, telegram_id)
+                await redis_client.expire(page_sent, BROADCAST_TTL)
+
+            counts = await send_many(bot, pending, text, parse_mode, on_sent=remember)
+
+            # Чекпоинт страницы: позиция и счётчики одной транзакцией
+            last_id = rows[-1].id
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(key, "last_id", last_id)
+                pipe.hincrby(key, "processed", len(rows))
+                for name, value in counts.items():
+                    pipe.hincrby(key, name, value)
+                pipe.delete(page_sent)
+                await pipe.execute()
+
+            status = await broadcast_status(broadcast_id)
+            logging.info(
+                f"Рассылка {broadcast_id}: {status['processed']}/{status['total']}, "
+                f"{status['rate']} сообщ./с, осталось ~{status['eta']} с."
+            )
+            if time.monotonic() >= deadline:
+                break
+
+    # Слайс кончился - продолжение отдельной задачей с новой позицией
+    await enqueue("broadcast", key=f"broadcast:{broadcast_id}:{last_id}", broadcast_id=broadcast_id)
+
+
+async def stop_broadcast(broadcast_id: str):
+    await redis_client.hset(broadcast_key(broadcast_id), "status", "stopped")
+
+
+# --- Предупреждения о скором снятии публикации ---
+@job("expiry_warnings", max_retries=2)
+async def job_expiry_warnings(bot):
+    """Пишет владельцам постов, которые снимутся в ближайшие EXPIRY_WARNING секунд"""
+    now = datetime.now(timezone.utc)
+    async with async_session() as session:
+        # Тот же частичный индекс ix_drafts_expires_at, что и у снятия просроченных
+        result = await session.execute(
+            select(User.telegram_id, Draft.id, Draft.expires_at)
+            .join(User, User.id == Draft.user_id)
+            .where(
+                Draft.is_draft == False,
+                Draft.expires_at > now,
+                Draft.expires_at <= now + timedelta(seconds=EXPIRY_WARNING),
+                User.is_blocked == False
+            )
+            .order_by(Draft.expires_at)
+        )
+        rows = result.all()
+
+    # Одно предупреждение на публикацию: ключ включает срок, повторная публикация получит своё.
+    # Ключ ставится только после отправки, поэтому неудачные предупреждения уйдут в следующий раз
+    warned_keys = {}
+    by_hours = {}
+    for row in rows:
+        key = f"expiry_warned:{row.id}:{int(row.expires_at.timestamp())}"
+        if not await redis_client.exists(key):
+            warned_keys[row.telegram_id] = key
+            hours = max(1, int((row.expires_at - now).total_seconds() // 3600))
+            by_hours.setdefault(hours, []).append(row)
+
+    async def remember(telegram_id: int):
+        await redis_client.set(warned_keys[telegram_id], "1", ex=EXPIRY_WARNING * 2)
+
+    warned = 0
+    for hours, recipients in by_hours.items():
+        counts = await send_many(bot, recipients, (
+            f"⏳ Твоё резюме будет снято с публикации примерно через {hours} ч.\n"
+            "После этого оно вернётся в черновики, и его можно будет опубликовать снова."
+        ), on_sent=remember)
+        warned += counts["sent"]
+    if warned:
+        logging.info(f"Отправлено предупреждений о снятии публикации: {warned}")
+
+
+async def schedule_expiry_warnings():
+    """Раз в EXPIRY_WARNING_INTERVAL ставит проверку в очередь, одну на окно для всех воркеров"""
+    while True:
+        try:
+            window = int(time.time() // EXPIRY_WARNING_INTERVAL)
+            await enqueue("expiry_warnings", key=f"expiry_warnings:{window}")
+        except Exception as e:
+            logging.error(f"Не удалось поставить предупреждения о снятии: {e}")
+        await asyncio.sleep(EXPIRY_WARNING_INTERVAL)
+
+
+if __name__ == "__main__":
+    # python broadcast.py "текст" - запустить, python broadcast.py status|stop <id>
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:2] == ["status"]:
+        print(asyncio.run(broadcast_status(sys.argv[2])))
+    elif sys.argv[1:2] == ["stop"]:
+        asyncio.run(stop_broadcast(sys.argv[2]))
+    else:
+        print(asyncio.run(start_broadcast(" ".join(sys.argv[1:]))))
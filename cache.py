@@ -0,0 +1,159 @@
+# cache.py
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+from cachetools import TTLCache
+
+from db import redis_client
+
+# Канал, через который контейнеры app и worker сообщают друг другу об изменениях
+INVALIDATION_CHANNEL = "cache:invalidate"
+# Уникальный id процесса, чтобы не обрабатывать собственные сообщения
+INSTANCE_ID = uuid.uuid4().hex
+
+# Небольшой локальный LRU перед Redis. TTL страхует от потерянных сообщений pub/sub
+local_cache = TTLCache(
+    maxsize=int(os.getenv("LOCAL_CACHE_SIZE", 10000)),
+    ttl=int(os.getenv("LOCAL_CACHE_TTL", 60))
+)
+
+
+def local_get(key: str):
+    return local_cache.get(key)
+
+
+def local_set(key: str, value):
+    local_cache[key] = value
+
+
+def local_drop(*keys: str):
+    for key in keys:
+        local_cache.pop(key, None)
+
+
+async def publish_invalidation(*keys: str):
+    """Сообщает другим процессам, что ключи нужно убрать из локального кеша"""
+    if not keys:
+        return
+    payload = json.dumps({"src": INSTANCE_ID, "keys": list(keys)})
+    await redis_client.publish(INVALIDATION_CHANNEL, payload)
+
+
+async def listen_invalidations():
+    """Слушает канал инвалидации и чистит локальный кеш"""
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Пока не были подписаны, могли пропустить сообщения
+            local_cache.clear()
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                data = json.loads(message["data"])
+                if data.get("src") == INSTANCE_ID:
+                    continue
+                local_drop(*data.get("keys", []))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка в подписке на инвалидацию кеша: {e}")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+
+# --- Защита от stampede ---
+LEASE_TTL_MS = int(os.getenv("CACHE_LEASE_TTL_MS", 3000))
+_RELEASE_LEASE = redis_client.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+)
+_RENEW_LEASE = redis_client.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+)
+
+_inflight = {}          # {ключ: Future} — загрузки, которые уже идут в этом процессе
+_background = set()     # ссылки на фоновые обновления, чтобы их не собрал GC
+
+
+async def single_flight(key: str, loader):
+    """Склеивает одновременные промахи по одному ключу в один вызов loader()"""
+    future = _inflight.get(key)
+    if future is not None:
+        return await asyncio.shield(future)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        result = await loader()
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Помечаем исключение полученным, если ждущих не было
+        future.exception()
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        _inflight.pop(key, None)
+
+
+def refresh_in_background(key: str, loader):
+    """Запускает обновление ключа в фоне, если оно ещё не идёт"""
+    if key in _inflight:
+        return
+    task = asyncio.create_task(single_flight(key, loader))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    task.add_done_callback(_log_background_error)
+
+
+def _log_background_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logging.warning(f"Ошибка фонового обновления кеша: {task.exception()}")
+
+
+@asynccontextmanager
+async def redis_lease(key: str, ttl_ms: int = LEASE_TTL_MS, keepalive: bool = False):
+    """Распределённая аренда на заполнение ключа: отдаёт True, если аренда наша.
+    Снимается только своя аренда (по токену). keepalive=True продлевает её каждые
+    ttl_ms / 3, пока блок выполняется - для задач, длительность которых заранее неизвестна"""
+    lease_key = f"lease:{key}"
+    token = uuid.uuid4().hex
+    acquired = await redis_client.set(lease_key, token, nx=True, px=ttl_ms)
+    renewer = asyncio.create_task(_keep_lease(lease_key, token, ttl_ms)) if acquired and keepalive else None
+    try:
+        yield bool(acquired)
+    finally:
+        if renewer:
+            renewer.cancel()
+            await asyncio.gather(renewer, return_exceptions=True)
+        if acquired:
+            await _RELEASE_LEASE(keys=[lease_key], args=[token])
+
+
+async def _keep_lease(lease_key: str, token: str, ttl_ms: int):
+    while True:
+        await asyncio.sleep(ttl_ms / 3000)
+        try:
+            if not await _RENEW_LEASE(keys=[lease_key], args=[token, ttl_ms]):
+                logging.warning(f"Аренда {lease_key} потеряна")
+                return
+        except Exception as e:
+            logging.warning(f"Не удалось продлить аренду {lease_key}: {e}")
+
+
+def should_refresh_early(expires_at: float, delta: float, beta: float = 1.0) -> bool:
+    """Вероятностное раннее обновление (XFetch): чем ближе истечение TTL
+    и чем дороже загрузка (delta), тем выше шанс обновить ключ заранее"""
+    return time.time() - delta * beta * math.log(random.random() or 1e-12) >= expires_at
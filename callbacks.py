@@ -0,0 +1,95 @@
+# callbacks.py
+from enum import StrEnum
+
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.filters.callback_data import CallbackData
+
+from metrics import HANDLER_ERRORS, HANDLER_LATENCY, timed
+
+
+class Action(StrEnum):
+    """Кнопки без параметров. Значения совпадают со старыми строками,
+    поэтому кнопки в уже отправленных сообщениях продолжают работать"""
+    EDIT_PHOTO = "edit_photo"
+    EDIT_DESC = "edit_desc"
+    EDIT_CONTACT = "edit_contact"
+    CHOOSE_TOPIC = "choose_topic"
+    SAVE_DRAFT = "save_draft"
+    IN_DRAFT_CONFIRM = "in_draft_confirm"
+    IN_DRAFT_CANCEL = "in_draft_cancel"
+    DELETE = "delete"
+    DELETE_CONFIRM = "delete_confirm"
+    DELETE_CANCEL = "delete_cancel"
+    PUBLISH = "publish"
+
+
+class RateCallback(CallbackData, prefix="rate", sep="_"):
+    """rate_<id получателя>_<оценка>"""
+    target_user_id: int
+    score: int
+
+
+class TopicCallback(CallbackData, prefix="topic", sep="_"):
+    """topic_<web|bots|ai|cancel>"""
+    name: str
+
+
+class CallbackRegistry:
+    """Маршрутизация callback_data по словарю вместо цепочки фильтров:
+    точное совпадение для Action, по префиксу для CallbackData.
+    Данные разбираются один раз и передаются в хэндлер как callback_data"""
+
+    def __init__(self, sep: str = "_"):
+        self.sep = sep          # общий разделитель всех CallbackData: префикс ищется одним split
+        self._exact = {}        # {callback_data: хэндлер}
+        self._prefixed = {}     # {prefix: (класс CallbackData, хэндлер)}
+
+    def action(self, *actions: Action):
+        def decorator(handler):
+            for action in actions:
+                self._exact[str(action)] = CallableObject(handler)
+            return handler
+        return decorator
+
+    def factory(self, callback_class: type[CallbackData]):
+        def decorator(handler):
+            if callback_class.__separator__ != self.sep:
+                raise ValueError(f"{callback_class.__name__}: разделитель должен быть {self.sep!r}")
+            self._prefixed[callback_class.__prefix__] = (callback_class, CallableObject(handler))
+            return handler
+        return decorator
+
+    def resolve(self, data: str | None):
+        """Возвращает (хэндлер, разобранные данные) или None"""
+        if not data:
+            return None
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, None
+        prefixed = self._prefixed.get(data.split(self.sep, 1)[0])
+        if prefixed is None:
+            return None
+        callback_class, handler = prefixed
+        try:
+            return handler, callback_class.unpack(data)
+        except (TypeError, ValueError):
+            return None
+
+    def register(self, router):
+        """Вешает на router один хэндлер callback_query, который раздаёт апдейты по таблице"""
+        async def dispatch_callback(callback, **data):
+            resolved = self.resolve(callback.data)
+            if resolved is None:
+                return UNHANDLED
+            handler, callback_data = resolved
+            # Время считается здесь: снаружи виден только общий dispatch_callback
+            name = handler.callback.__name__
+            try:
+                with timed(HANDLER_LATENCY, name):
+                    return await handler.call(callback, callback_data=callback_data, **data)
+            except Exception:
+                HANDLER_ERRORS.labels(name).inc()
+                raise
+
+        router.callback_query.register(dispatch_callback)
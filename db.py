@@ -1,25 +1,54 @@
 # db.py
-import asyncio
 import os
 import secrets
+import time
 from datetime import datetime
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship
-from sqlalchemy import Column, Integer, BigInteger, Text, DateTime, func, Boolean, ForeignKey, UniqueConstraint
+from contextlib import asynccontextmanager
+from sqlalchemy.orm import sessionmaker, declarative_base, relationship, Session
+from sqlalchemy import Column, Integer, BigInteger, Text, DateTime, func, Boolean, ForeignKey, UniqueConstraint, Index, text, event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from dotenv import load_dotenv
 import redis.asyncio as redis
+from metrics import DB_POOL_WAIT, DB_QUERY_LATENCY, REDIS_LATENCY
 
 load_dotenv()
 
 REDIS_URL = f"redis://{os.getenv('REDIS_HOST')}:{os.getenv('REDIS_PORT')}/0"
 redis_pool = redis.ConnectionPool.from_url(REDIS_URL)
-redis_client = redis.Redis.from_pool(redis_pool)
+
+
+class InstrumentedRedis(redis.Redis):
+    """Клиент Redis, который пишет время каждой команды в метрики"""
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_LATENCY.labels(str(args[0]).upper()).observe(time.perf_counter() - start)
+
+
+redis_client = InstrumentedRedis.from_pool(redis_pool)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Пул, который замеряет ожидание свободного соединения"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT.observe(time.perf_counter() - start)
+
 
 # Настройка пула подключений к базе данных
 DATABASE_URL = f"postgresql+asyncpg://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}/{os.getenv('DB_NAME')}"
 engine = create_async_engine(
     DATABASE_URL, 
     echo=False,
+    poolclass=TimedQueuePool,
     pool_size=20,
     max_overflow=40,
     pool_recycle=1800,  
@@ -28,6 +57,63 @@ engine = create_async_engine(
 async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 Base = declarative_base()
 
+# Счётчики выдачи соединений из пула: общий и по каждой сессии (session.info["checkouts"])
+pool_stats = {"checkouts": 0}
+
+
+@event.listens_for(engine.sync_engine.pool, "checkout")
+def _count_pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_stats["checkouts"] += 1
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info["query_start"].pop()
+    # Метка - тип запроса (SELECT, INSERT, ...), чтобы не плодить серии на каждый текст
+    DB_QUERY_LATENCY.labels(statement.lstrip().split(None, 1)[0].upper()).observe(time.perf_counter() - start)
+
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def _drop_query_timer(context):
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+
+@event.listens_for(Session, "after_begin")
+def _count_session_checkout(session, transaction, connection):
+    session.info["checkouts"] = session.info.get("checkouts", 0) + 1
+
+
+def after_commit(session: AsyncSession, callback):
+    """Откладывает корутину-функцию (например, запись в кеш) до коммита сессии"""
+    session.info.setdefault("after_commit", []).append(callback)
+
+
+async def commit(session: AsyncSession):
+    """Коммитит сессию и выполняет отложенные after_commit-колбэки"""
+    await session.commit()
+    callbacks = session.info.pop("after_commit", [])
+    for callback in callbacks:
+        await callback()
+
+
+@asynccontextmanager
+async def session_scope(session: AsyncSession | None = None):
+    """Работает в переданной сессии запроса (коммит сделает DbSessionMiddleware)
+    или открывает собственную и коммитит её на выходе"""
+    if session is not None:
+        yield session
+        await session.flush()
+        return
+    async with async_session() as own_session:
+        yield own_session
+        await commit(own_session)
+
 
 # === Пользователь ===
 class User(Base):
@@ -37,8 +123,13 @@ class User(Base):
     username = Column(Text)
     id_key = Column(Text, unique=True, nullable=False, default=lambda: secrets.token_hex(8))
     rating = Column(Integer, default=0)
+    # Агрегаты рейтинга обновляются вместе со вставкой в ratings
+    rating_sum = Column(Integer, nullable=False, default=0, server_default="0")
+    rating_count = Column(Integer, nullable=False, default=0, server_default="0")
     last_key_update = Column(DateTime(timezone=True), default=func.now())
     is_first_visit = Column(Boolean, default=True)
+    # Пользователь заблокировал бота - рассылки его пропускают
+    is_blocked = Column(Boolean, nullable=False, default=False, server_default="false")
 
     drafts = relationship("Draft", back_populates="user", cascade="all, delete-orphan")
     
@@ -62,12 +153,23 @@ class Draft(Base):
     theme_change_count = Column(Integer, default=0)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     published_at = Column(DateTime(timezone=True))
+    # published_at + срок публикации, по нему ищет просроченные посты tasks.py
+    expires_at = Column(DateTime(timezone=True))
     paid = Column(Boolean, default=False)
     payment_id = Column(Text)
+    # Последний известный статус платежа ЮKassa (см. payments.py)
+    payment_status = Column(Text)
     is_draft = Column(Boolean, default=True)
     last_hash = Column(Text)
 
     user = relationship("User", back_populates="drafts")
+
+    # Один черновик на пользователя, на этом же ограничении держится upsert
+    __table_args__ = (
+        UniqueConstraint("user_id", name="uq_drafts_user_id"),
+        Index("ix_drafts_expires_at", "expires_at", postgresql_where=text("is_draft = false")),
+        Index("ix_drafts_payment_id", "payment_id", postgresql_where=text("payment_id IS NOT NULL")),
+    )
     
 
 class Rating(Base):
@@ -80,17 +182,11 @@ class Rating(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 
-    __table_args__ = (UniqueConstraint("from_user_id", "to_user_id", name="unique_rating"),)
+    __table_args__ = (
+        UniqueConstraint("from_user_id", "to_user_id", name="unique_rating"),
+        Index("ix_ratings_to_user_id", "to_user_id"),
+    )
 
 
     from_user = relationship("User", foreign_keys=[from_user_id], backref="given_ratings")
     to_user = relationship("User", foreign_keys=[to_user_id], backref="received_ratings")
-
-
-async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-
-if __name__ == "__main__":
-    asyncio.run(init_db())
-    print("База данных и таблицы созданы!")
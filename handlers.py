@@ -1,30 +1,35 @@
 import re
 import os
+import asyncio
 import logging
+from functools import partial
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from aiogram import types, F, Router
 from aiogram.types import InputMediaPhoto, Message
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from sqlalchemy import select, func
-from db import async_session, User, Rating, Draft
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import User, Draft, redis_client, after_commit, async_session, commit
+from tasks import schedule_expiry, cancel_expiry
 from keyboard import draft_keyboard, main_menu_keyboard, payment_menu_keyboard, rating_keyboard, confirm_delete_draft, confirm_in_draft, topic_keyboard
-from services import get_draft, create_or_update_draft, delete_draft, register_user, refresh_id_key
-from services_payment import create_payment, check_payment_status
+from services import get_draft, create_or_update_draft, delete_draft, register_user, refresh_id_key, get_user_id, get_rating_totals, add_rating
+from services_payment import create_payment
+from outbound import outbound, post_editor, HIGH
+from jobs import job, enqueue, Retry
+from cache import redis_lease
+from callbacks import Action, CallbackRegistry, RateCallback, TopicCallback
+from render import render_post, render_draft_card, render_profile, theme_list
 
 load_dotenv()
 CHAT_ID = int(os.getenv("CHAT_ID"))
 
 router = Router()
-
-theme_list = {
-    "web": 12,
-    "tg bots": 5,
-    "ai": 159
-}
+callbacks = CallbackRegistry()
 
 # === FSM для редактирования ===
 class EditDraft(StatesGroup):
@@ -36,8 +41,83 @@ class EditDraft(StatesGroup):
 #========================================================
 # Обновление и показ опубликованного поста или черновика 
 #========================================================
-async def show_draft(user_id: int, target: types.Message, only_draft: bool = True):
-    draft = await get_draft(user_id)
+# Карточка черновика в личке правится на месте, пока её можно редактировать
+DRAFT_CARD_MAX_AGE = int(os.getenv("DRAFT_CARD_MAX_AGE", 47 * 60 * 60))
+
+
+def draft_card_key(chat_id: int) -> str:
+    return f"draft_card:{chat_id}"
+
+
+async def send_draft_card(bot, chat_id: int, text: str, photo: str | None = None):
+    """Отправляет новую карточку и запоминает её id"""
+    if photo:
+        call = partial(bot.send_photo, chat_id=chat_id, photo=photo, caption=text,
+                       parse_mode="Markdown", reply_markup=draft_keyboard())
+    else:
+        call = partial(bot.send_message, chat_id=chat_id, text=text, parse_mode="Markdown",
+                       reply_markup=draft_keyboard())
+    sent = await outbound.call(call, lane=HIGH)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(draft_card_key(chat_id))
+        pipe.hset(draft_card_key(chat_id), mapping={"message_id": sent.message_id, "photo": photo or ""})
+        # Ключ живёт столько, сколько карточку можно править
+        pipe.expire(draft_card_key(chat_id), DRAFT_CARD_MAX_AGE)
+        await pipe.execute()
+
+
+async def _edit_card(call) -> bool:
+    try:
+        await call()
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return True
+        # Сообщение удалено пользователем или стало слишком старым
+        logging.info(f"Карточку черновика не удалось изменить: {e}")
+        return False
+    return True
+
+
+async def edit_draft_card(bot, chat_id: int, text: str, photo: str | None = None) -> bool:
+    """Правит последнюю карточку. False - карточки нет и нужно отправить новую"""
+    card = await redis_client.hgetall(draft_card_key(chat_id))
+    if not card:
+        return False
+    message_id = int(card[b"message_id"])
+    old_photo = card[b"photo"].decode()
+    photo = photo or ""
+
+    if bool(photo) != bool(old_photo):
+        # Текстовое сообщение нельзя превратить в фото и обратно - заменяем карточку
+        await outbound.submit(partial(bot.delete_message, chat_id=chat_id, message_id=message_id),
+                              lane=HIGH, key=(chat_id, message_id))
+        return False
+
+    if photo and photo == old_photo:
+        call = partial(bot.edit_message_caption, chat_id=chat_id, message_id=message_id, caption=text,
+                       parse_mode="Markdown", reply_markup=draft_keyboard())
+    elif photo:
+        media = InputMediaPhoto(media=photo, caption=text, parse_mode="Markdown")
+        call = partial(bot.edit_message_media, chat_id=chat_id, message_id=message_id, media=media,
+                       reply_markup=draft_keyboard())
+    else:
+        call = partial(bot.edit_message_text, chat_id=chat_id, message_id=message_id, text=text,
+                       parse_mode="Markdown", reply_markup=draft_keyboard())
+
+    if not await outbound.call(partial(_edit_card, call), lane=HIGH, key=(chat_id, message_id)):
+        return False
+    if photo != old_photo:
+        await redis_client.hset(draft_card_key(chat_id), "photo", photo)
+    return True
+
+
+async def show_draft(user_id: int, target: types.Message, only_draft: bool = True, session=None, in_place: bool = True):
+    """Показывает карточку черновика. in_place=False - всегда новым сообщением (вызов из меню)"""
+    draft = await get_draft(user_id, session=session)
+    if session is not None:
+        # Транзакция закрывается до вызовов Telegram: ожидание лимитов и RetryAfter
+        # не должно держать соединение из пула и блокировку строки черновика
+        await commit(session)
     if not draft:
         await target.answer("У тебя пока нет черновика.")
         return
@@ -49,134 +129,227 @@ async def show_draft(user_id: int, target: types.Message, only_draft: bool = Tru
         await target.answer("Пока нет опубликованных услуг.")
         return
 
-    text = "📰 *Твой черновик*\n" + "─" * 30 + "\n"
-    if not draft.is_draft:
-        if draft.message_id:
-            text += f"🔗 *Главная ссылка*: https://t.me/SkillFlows/1/{draft.message_id}\n"
-            if draft.theme_message_id:
-                text += f"🔗 *Тематическая ссылка*: https://t.me/SkillFlows/{theme_list[draft.theme_name]}/{draft.theme_message_id}\n\n"
-    text += f"✍️ *Описание:*\n{draft.description or '(не заполнено)'}\n\n"
-    text += f"👤 *Контакт:* @{draft.contact or '(не заполнено)'}\n"
-    text += f"📔 *Тема:* {draft.theme_name or '(темы нет)'}\n\n"
-    
+    text = render_draft_card(draft)
 
+    bot = target.bot
+    chat_id = target.chat.id
+    if in_place and await edit_draft_card(bot, chat_id, text, draft.photo):
+        return
+    await send_draft_card(bot, chat_id, text, draft.photo)
 
-    published_at = draft.published_at
-    if isinstance(published_at, str):
-        try:
-            published_at = datetime.fromisoformat(published_at)
-        except Exception:
-            published_at = None
-
-    if published_at and not draft.is_draft:
-        expiry = published_at + timedelta(days=30)
-        remaining = expiry - datetime.now(timezone.utc)
-        days, seconds = remaining.days, remaining.seconds
-        hours = seconds // 3600
-        minutes = (seconds % 3600) // 60
-        if remaining.total_seconds() > 0:
-            text += f"⏳ Осталось до окончания: {days} дн. {hours} ч. {minutes} мин.\n"
-        else:
-            text += "⏳ Срок публикации истёк!\n"
-            
-    text += "─" * 30
 
-    bot = target.bot
-    if draft.photo:
-        await bot.send_photo(chat_id=target.chat.id, photo=draft.photo, caption=text,
-                             parse_mode="Markdown", reply_markup=draft_keyboard())
+async def send_post(bot, text: str, photo: str | None = None, thread_id: int | None = None) -> int:
+    """Отправляет пост в группу (или в тему thread_id) и возвращает id сообщения"""
+    if photo:
+        call = partial(bot.send_photo, chat_id=CHAT_ID, photo=photo, caption=text,
+                       parse_mode="Markdown", message_thread_id=thread_id)
     else:
-        await bot.send_message(chat_id=target.chat.id, text=text, parse_mode="Markdown",
-                               reply_markup=draft_keyboard())
-        
-        
-async def update_post(user_id: int):
-    from bot import bot
-
-    draft = await get_draft(user_id)
+        call = partial(bot.send_message, chat_id=CHAT_ID, text=text,
+                       parse_mode="Markdown", message_thread_id=thread_id)
+    sent = await outbound.call(call)
+    await post_editor.remember(CHAT_ID, sent.message_id, text, photo)
+    return sent.message_id
+
+
+async def publish_post(bot, text: str, photo: str | None = None, thread_ids=(None,)) -> list[int]:
+    """Отправляет пост во все ветки одновременно.
+    Если хоть одна отправка не удалась, удаляет уже отправленные и поднимает ошибку"""
+    results = await asyncio.gather(
+        *(send_post(bot, text, photo, thread_id) for thread_id in thread_ids),
+        return_exceptions=True
+    )
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        sent = [r for r in results if not isinstance(r, Exception)]
+        logging.error(f"Публикация не удалась ({errors[0]}), удаляем отправленные сообщения {sent}")
+        await unpublish_post(bot, *sent)
+        raise errors[0]
+    return results
+
+
+async def unpublish_post(bot, *message_ids) -> list[int]:
+    """Удаляет сообщения поста одновременно и возвращает id тех, что удалить не удалось.
+    Уже удалённое сообщение ошибкой не считается, так что вызов можно повторять"""
+    message_ids = [m for m in message_ids if m]
+    futures = []
+    for message_id in message_ids:
+        post_editor.cancel(CHAT_ID, message_id)
+        futures.append(await outbound.submit(
+            partial(bot.delete_message, chat_id=CHAT_ID, message_id=message_id),
+            key=(CHAT_ID, message_id)
+        ))
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    return [
+        message_id for message_id, r in zip(message_ids, results)
+        if isinstance(r, Exception) and "message to delete not found" not in str(r)
+    ]
+
+
+async def update_post(user_id: int, session=None, bot=None):
+    if bot is None:
+        from bot import bot
+
+    draft = await get_draft(user_id, session=session)
     if not draft or draft.is_draft or not draft.message_id:
         return True
 
-    async with async_session() as session:
-        result = await session.execute(select(User).where(User.telegram_id == user_id))
-        user = result.scalar_one_or_none()
+    internal_id = await get_user_id(user_id, session=session)
+    rating_sum, rating_count = await get_rating_totals(internal_id, session=session)
+    full_text = render_post(draft, rating_sum, rating_count)
 
-        avg_query = await session.execute(
-            select(func.avg(Rating.score), func.count(Rating.id))
-            .where(Rating.to_user_id == user.id)
+    theme_message_id = draft.theme_message_id
+    if draft.theme_name and draft.theme_change_count == 2 and draft.theme_name in theme_list:
+        # Сначала новое сообщение в новой теме, старое удаляем только после успеха
+        try:
+            theme_message_id = await send_post(bot, full_text, draft.photo, theme_list[draft.theme_name])
+        except Exception as e:
+            logging.error(f"Не удалось перенести пост {user_id} в тему {draft.theme_name}: {e}")
+            return False
+        await create_or_update_draft(
+            telegram_id=user_id,
+            theme_message_id=theme_message_id,
+            theme_change_count=3,
+            session=session
         )
-        avg_score, review_count = avg_query.first()
+        if draft.theme_message_id:
+            post_editor.cancel(CHAT_ID, draft.theme_message_id)
+            await outbound.submit(
+                partial(bot.delete_message, chat_id=CHAT_ID, message_id=draft.theme_message_id),
+                key=(CHAT_ID, draft.theme_message_id)
+            )
 
-        avg_score = round(avg_score or 0, 1)
-        review_count = review_count or 0
+    # Правки склеиваются за окно и уходят одной, если пост действительно изменился
+    for message_id in (draft.message_id, theme_message_id):
+        if message_id:
+            post_editor.schedule(bot, CHAT_ID, message_id, full_text, draft.photo)
 
-    rating_line = (
-        f"⭐️ Рейтинг: {avg_score} / ({review_count})\n\n"
-        if review_count > 0 else "Пока нет отзывов\n\n"
-    )
 
-    full_text = (
-        f"{draft.description or '(нет описания)'}\n\n"
-        f"{rating_line}"
-    )
-    if draft.contact:
-        full_text += f"📩 [Связаться со мной](https://t.me/{draft.contact})"
+    return True
 
 
-    if draft.theme_name and draft.theme_change_count == 2:
-        if draft.theme_message_id:
-             await bot.delete_message(chat_id=CHAT_ID, message_id=draft.theme_message_id)
-
-
-        if draft.theme_name in theme_list:
-            thread_id = theme_list[draft.theme_name]
-            if draft.photo:
-                sent_thread = await bot.send_photo(
-                    chat_id=CHAT_ID,
-                    photo=draft.photo,
-                    caption=full_text,
-                    parse_mode="Markdown",
-                    message_thread_id=thread_id
-                )
-            else:
-                sent_thread = await bot.send_message(
-                    chat_id=CHAT_ID,
-                    text=full_text,
-                    parse_mode="Markdown",
-                    message_thread_id=thread_id
-                )
+#===============================================
+# Фоновые задачи: выполняет worker.py (см. jobs.py)
+#===============================================
+async def notify(bot, chat_id: int, text: str):
+    await outbound.submit(partial(bot.send_message, chat_id=chat_id, text=text), lane=HIGH)
+
 
-            await create_or_update_draft(
-                telegram_id=user_id,
-                theme_message_id=sent_thread.message_id,
-                theme_change_count=3
+# Срок публикации: по нему ставится drafts.expires_at, а снятие, таймер и обратный отсчёт читают только его
+PUBLISH_DAYS = int(os.getenv("PUBLISH_DAYS", 30))
+# Аренда публикации продлевается, пока задача жива; TTL - сколько ждать после падения воркера
+PUBLISH_LOCK_TTL = int(os.getenv("PUBLISH_LOCK_TTL", 60))
+
+
+async def publish_failed(bot, error, telegram_id: int, chat_id: int):
+    await notify(bot, chat_id, "❌ Не удалось опубликовать резюме, попробуйте позже.")
+
+
+@job("publish_draft", max_retries=3, on_dead=publish_failed)
+async def job_publish_draft(bot, telegram_id: int, chat_id: int):
+    """Публикует черновик в группу и сообщает пользователю результат.
+    Отправка в группу идёт вне транзакции: под лимитами Telegram она может занять минуты,
+    и держать всё это время соединение с блокировкой строки нельзя"""
+    # Повторное нажатие «Опубликовать» ждёт, пока первая задача не закончит.
+    # Аренда продлевается, пока идёт отправка, и снимается только своя
+    async with redis_lease(f"publish:{telegram_id}", PUBLISH_LOCK_TTL * 1000, keepalive=True) as acquired:
+        if not acquired:
+            raise Retry(f"публикация {telegram_id} уже выполняется", delay=10)
+        async with async_session() as session:
+            result = await session.execute(
+                select(Draft, User)
+                .join(User, User.id == Draft.user_id)
+                .where(User.telegram_id == telegram_id)
             )
-            
-            full_text += f"\u200B"
-            
-    if draft.photo:
-        media = InputMediaPhoto(media=draft.photo, caption=full_text, parse_mode="Markdown")
-        await bot.edit_message_media(chat_id=CHAT_ID, message_id=draft.message_id, media=media)
-        if draft.theme_message_id:
-            await bot.edit_message_media(chat_id=CHAT_ID, message_id=draft.theme_message_id, media=media)
-    else:
-        await bot.edit_message_text(chat_id=CHAT_ID, message_id=draft.message_id, text=full_text, parse_mode="Markdown")
-        if draft.theme_message_id:
-            await bot.edit_message_text(chat_id=CHAT_ID, message_id=draft.theme_message_id, text=full_text, parse_mode="Markdown")
+            row = result.first()
+        if not row:
+            return
+        draft, user = row
+        if not draft.is_draft and draft.message_id:
+            return
+        if draft.theme_name not in theme_list:
+            await notify(bot, chat_id, "❌ Нужно заполнить хотя бы описание, контакт и тему!")
+            return
 
+        full_text = render_post(draft, user.rating_sum, user.rating_count)
+        # Основной пост и пост в теме уходят одновременно
+        main_id, thread_id = await publish_post(
+            bot, full_text, draft.photo, thread_ids=(None, theme_list[draft.theme_name])
+        )
+
+        async with async_session() as session:
+            try:
+                # Короткая транзакция только на запись. Если блокировка в Redis истекла
+                # и пост уже опубликовала другая задача, наш - лишний
+                current = (await session.execute(
+                    select(Draft.is_draft, Draft.message_id)
+                    .where(Draft.id == draft.id)
+                    .with_for_update()
+                )).first()
+                if not current or (not current.is_draft and current.message_id):
+                    await unpublish_post(bot, main_id, thread_id)
+                    return
+                now = datetime.now(timezone.utc)
+                published = await create_or_update_draft(
+                    telegram_id,
+                    message_id=main_id,
+                    theme_message_id=thread_id,
+                    is_draft=False,
+                    published_at=now,
+                    expires_at=now + timedelta(days=PUBLISH_DAYS),
+                    theme_change_count=1,
+                    session=session
+                )
+                await session.commit()
+            except Exception:
+                # Без записи в БД посты в группе никто не снимет, а повтор задачи отправит их ещё раз
+                await unpublish_post(bot, main_id, thread_id)
+                raise
+            # Коммит уже сделан - здесь выполняются только after_commit-колбэки (кеш, расписание)
+            after_commit(session, partial(schedule_expiry, published.id, published.expires_at))
+            await commit(session)
+
+    await notify(bot, chat_id, "✅ Резюме опубликовано! Теперь оно в разделе 'Опубликованные'.")
+
+
+async def update_failed(bot, error, telegram_id: int, chat_id: int):
+    await notify(bot, chat_id, "❌ Ошибка при обновлении поста.")
+
+
+@job("update_post", max_retries=3, on_dead=update_failed)
+async def job_update_post(bot, telegram_id: int, chat_id: int):
+    if not await update_post(telegram_id, bot=bot):
+        raise RuntimeError(f"Не удалось обновить пост пользователя {telegram_id}")
+    await notify(bot, chat_id, "✅ Резюме обновлено!")
+
+
+@job("delete_post", max_retries=8)
+async def job_delete_post(bot, message_ids: list[int]):
+    failed = await unpublish_post(bot, *message_ids)
+    if failed:
+        raise RuntimeError(f"Не удалось удалить сообщения {failed}")
+
+
+async def enqueue_delete_post(*message_ids):
+    """Удаление поста из группы с повторами в воркере. Вызывать после коммита"""
+    message_ids = [m for m in message_ids if m]
+    if not message_ids:
+        return
+    for message_id in message_ids:
+        post_editor.cancel(CHAT_ID, message_id)
+    await enqueue("delete_post", key=f"delete_post:{':'.join(map(str, message_ids))}", message_ids=message_ids)
 
-    return True
 
 @router.message(Command("start"))
-async def cmd_start(message: types.Message, state: FSMContext):
+async def cmd_start(message: types.Message, state: FSMContext, session: AsyncSession):
     args = message.text.split()
     if len(args) > 1 and args[1].startswith("rate_"):
         id_key = args[1].replace("rate_", "")
-        await start_rate_flow(message, id_key, state)
+        await start_rate_flow(message, id_key, state, session)
         return
 
-    user = await register_user(message.from_user.id, message.from_user.username)
-    await refresh_id_key(user)
+    user = await register_user(message.from_user.id, message.from_user.username, session=session)
+    await refresh_id_key(user, session=session)
+    await commit(session)
 
     text = (
         f"👋 <b>Добро пожаловать, {message.from_user.full_name}!</b>\n\n"
@@ -198,25 +371,27 @@ async def cmd_start(message: types.Message, state: FSMContext):
 #==================================
 
 @router.message(F.text == "📝 Черновики")
-async def msg_show_drafts(message: types.Message):
-    await show_draft(message.from_user.id, message, only_draft=True)
+async def msg_show_drafts(message: types.Message, session: AsyncSession):
+    await show_draft(message.from_user.id, message, only_draft=True, session=session, in_place=False)
 
 
 @router.message(F.text == "📢 Опубликованные")
-async def msg_show_published(message: types.Message):
-    draft = await get_draft(message.from_user.id)
+async def msg_show_published(message: types.Message, session: AsyncSession):
+    draft = await get_draft(message.from_user.id, session=session)
+    await commit(session)
     if draft and not draft.is_draft and draft.message_id:
-        await show_draft(message.from_user.id, message, only_draft=False)
+        await show_draft(message.from_user.id, message, only_draft=False, session=session, in_place=False)
     else:
         await message.answer("Пока нет опубликованных услуг.")
 
 
 @router.message(F.text == "✍️ Создать резюме")
-async def msg_create_resume(message: types.Message):
+async def msg_create_resume(message: types.Message, session: AsyncSession):
     user_id = message.from_user.id
-    draft = await get_draft(user_id)
+    draft = await get_draft(user_id, session=session)
     if not draft:
-        await create_or_update_draft(user_id, is_draft=True)
+        await create_or_update_draft(user_id, is_draft=True, session=session)
+        await commit(session)
         await message.answer("Черновик создан ✅", reply_markup=draft_keyboard())
     else:
         await message.answer("У тебя уже есть черновик.", reply_markup=main_menu_keyboard())
@@ -233,209 +408,208 @@ async def msg_help(message: types.Message):
     
     
 @router.message(F.text == "👤 Профиль")
-async def show_profile(message: Message):
-    async with async_session() as session:
-        result = await session.execute(
-            select(User).where(User.telegram_id == message.from_user.id)
-        )
-        user = result.scalar_one_or_none()
+async def show_profile(message: Message, session: AsyncSession):
+    user_id = await get_user_id(message.from_user.id, session=session)
+    if not user_id:
+        await message.answer("❌ Профиль не найден.")
+        return
 
-        if not user:
-            await message.answer("❌ Профиль не найден.")
-            return
+    user = await session.get(User, user_id)
+    await commit(session)
 
-        result = await session.execute(
-            select(
-                func.coalesce(func.avg(Rating.score), 0),
-                func.count(Rating.id)
-            ).where(Rating.to_user_id == user.id)
-        )
-        avg_rating, review_count = result.first()
-        free_vacancy_line = "✅ У вас есть бесплатная публикация" if user.is_first_visit else "❌ У вас нет бесплатной публикации" 
-        
-        text = (
-            f"👤 <b>Твой профиль</b>\n\n"
-            f"🆔 ID: <code>{user.telegram_id}</code>\n"
-            f"💬 Имя: {message.from_user.full_name}\n"
-            f"🔗 Ник: @{message.from_user.username or '—'}\n\n"
-            f"⭐ Средний рейтинг: <b>{round(avg_rating, 2)}</b>\n"
-            f"📝 Отзывов получено: <b>{review_count}</b>\n\n"
-            f"{free_vacancy_line}\n"
-            f"🔑 Ссылка для отзывов:\n"
-            f"<code>https://t.me/ITvacancyCreate_bot?start=rate_{user.id_key}</code>"
-        )
+    if not user:
+        await message.answer("❌ Профиль не найден.")
+        return
 
-        await message.answer(text, parse_mode="HTML")
+    text = render_profile(user, message.from_user.full_name, message.from_user.username)
+    await message.answer(text, parse_mode="HTML")
         
 
 #===================================
 # Меню вакансии(обработка сообщений) 
 #===================================
-@router.callback_query(F.data == "save_draft")
+@callbacks.action(Action.SAVE_DRAFT)
 async def cb_save_draft(callback: types.CallbackQuery):
     await callback.message.answer("Вы уверены, что хотите перенести опубликованную услугу в черновик? Вам придется опять оплатить публикацию", reply_markup=confirm_in_draft())
 
         
-@router.callback_query(F.data == "in_draft_confirm")
-async def cb_save_draft_confirm(callback: types.CallbackQuery):
-    draft = await get_draft(callback.from_user.id)
-    bot = callback.message.bot
+@callbacks.action(Action.IN_DRAFT_CONFIRM)
+async def cb_save_draft_confirm(callback: types.CallbackQuery, session: AsyncSession):
+    draft = await get_draft(callback.from_user.id, session=session)
 
     if not draft:
-        await create_or_update_draft(callback.from_user.id, is_draft=True)
+        await create_or_update_draft(callback.from_user.id, is_draft=True, session=session)
+        await commit(session)
         await callback.message.answer("Черновик сохранён ✅")
         return
 
     if not draft.is_draft and draft.message_id and draft.theme_name:
-        await bot.delete_message(chat_id=CHAT_ID, message_id=draft.message_id)
-        await bot.delete_message(chat_id=CHAT_ID, message_id=draft.theme_message_id)
-        await create_or_update_draft(callback.from_user.id, is_draft=True, message_id=None, paid=False)
+        await create_or_update_draft(callback.from_user.id, is_draft=True, message_id=None, paid=False, session=session)
+        after_commit(session, partial(cancel_expiry, draft.id))
+        # Сообщения из группы удалит воркер, повторяя при ошибках
+        after_commit(session, partial(enqueue_delete_post, draft.message_id, draft.theme_message_id))
+        await commit(session)
         await callback.message.answer("✅ Объявление перенесено в черновики и удалено из чата.")
     else:
-        await create_or_update_draft(callback.from_user.id, is_draft=True, paid=False)
+        await create_or_update_draft(callback.from_user.id, is_draft=True, paid=False, session=session)
+        await commit(session)
         await callback.message.answer("Черновик сохранён ✅")
         
         
-@router.callback_query(F.data == "in_draft_cancel")
-async def cb_save_draft_confirm(callback: types.CallbackQuery):
+@callbacks.action(Action.IN_DRAFT_CANCEL)
+async def cb_save_draft_cancel(callback: types.CallbackQuery):
     await callback.message.answer("Отмена переноса ✅")
     await callback.answer()
         
 
 
 # === Редактирование ===
-@router.callback_query(F.data == "edit_photo")
+@callbacks.action(Action.EDIT_PHOTO)
 async def cb_edit_photo(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.answer("Пришли фото или напиши «Без фото».")
     await state.set_state(EditDraft.photo)
 
 
 @router.message(EditDraft.photo, F.photo)
-async def set_photo(message: types.Message, state: FSMContext):
-    await create_or_update_draft(message.from_user.id, photo=message.photo[-1].file_id)
+async def set_photo(message: types.Message, state: FSMContext, session: AsyncSession):
+    await create_or_update_draft(message.from_user.id, photo=message.photo[-1].file_id, session=session)
+    await commit(session)
     await message.answer("Фото обновлено ✅", reply_markup=main_menu_keyboard())
-    draft = await get_draft(message.from_user.id)
-    await show_draft(message.from_user.id, message, only_draft=draft.is_draft)
+    draft = await get_draft(message.from_user.id, session=session)
+    await show_draft(message.from_user.id, message, only_draft=draft.is_draft, session=session)
     await state.clear()
 
 
 @router.message(EditDraft.photo, F.text)
-async def set_no_photo(message: types.Message, state: FSMContext):
+async def set_no_photo(message: types.Message, state: FSMContext, session: AsyncSession):
     if message.text.lower().strip() in ["без фото", "skip", "no photo"]:
-        await create_or_update_draft(message.from_user.id, photo=None)
+        await create_or_update_draft(message.from_user.id, photo=None, session=session)
+        await commit(session)
         await message.answer("Фото удалено ✅", reply_markup=main_menu_keyboard())
-        draft = await get_draft(message.from_user.id)
-        await show_draft(message.from_user.id, message, only_draft=draft.is_draft)
+        draft = await get_draft(message.from_user.id, session=session)
+        await show_draft(message.from_user.id, message, only_draft=draft.is_draft, session=session)
         await state.clear()
     else:
         await message.answer("Отправь фото или напиши «Без фото».")
 
 
-@router.callback_query(F.data == "edit_desc")
-async def cb_edit_desc(callback: types.CallbackQuery, state: FSMContext):
-    draft = await get_draft(callback.from_user.id)
+@callbacks.action(Action.EDIT_DESC)
+async def cb_edit_desc(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
+    draft = await get_draft(callback.from_user.id, session=session)
+    await commit(session)
     await callback.message.answer(f"Текущее описание:\n{draft.description or '(не заполнено)'}\n\nОтправь новое:")
     await state.set_state(EditDraft.description)
 
 
 @router.message(EditDraft.description, F.text)
-async def set_description(message: types.Message, state: FSMContext):
-    await create_or_update_draft(message.from_user.id, description=message.text)
+async def set_description(message: types.Message, state: FSMContext, session: AsyncSession):
+    await create_or_update_draft(message.from_user.id, description=message.text, session=session)
+    await commit(session)
     await message.answer("Описание обновлено ✅", reply_markup=main_menu_keyboard())
-    draft = await get_draft(message.from_user.id)
-    await show_draft(message.from_user.id, message, only_draft=draft.is_draft)
+    draft = await get_draft(message.from_user.id, session=session)
+    await show_draft(message.from_user.id, message, only_draft=draft.is_draft, session=session)
     await state.clear()
 
 
-@router.callback_query(F.data == "edit_contact")
-async def cb_edit_contact(callback: types.CallbackQuery, state: FSMContext):
-    draft = await get_draft(callback.from_user.id)
+@callbacks.action(Action.EDIT_CONTACT)
+async def cb_edit_contact(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
+    draft = await get_draft(callback.from_user.id, session=session)
+    await commit(session)
     await callback.message.answer(f"Текущий контакт: @{draft.contact or '(не заполнено)'}\n\nОтправь новый username:")
     await state.set_state(EditDraft.contact)
 
 
 @router.message(EditDraft.contact, F.text)
-async def set_contact(message: types.Message, state: FSMContext):
+async def set_contact(message: types.Message, state: FSMContext, session: AsyncSession):
     username = message.text.strip().lstrip("@")
     if not re.match(r"^[a-zA-Z0-9_]{5,32}$", username):
         await message.answer("❌ Некорректный username. Попробуй снова.")
         return
-    await create_or_update_draft(message.from_user.id, contact=username)
+    await create_or_update_draft(message.from_user.id, contact=username, session=session)
+    await commit(session)
     await message.answer("Контакт обновлён ✅", reply_markup=main_menu_keyboard())
-    draft = await get_draft(message.from_user.id)
-    await show_draft(message.from_user.id, message, only_draft=draft.is_draft)
+    draft = await get_draft(message.from_user.id, session=session)
+    await show_draft(message.from_user.id, message, only_draft=draft.is_draft, session=session)
     await state.clear()
     
 #=== Удаление вакансии ===    
-@router.callback_query(F.data == "delete")
+@callbacks.action(Action.DELETE)
 async def cb_delete_confirm(callback: types.CallbackQuery):
     await callback.message.answer("Вы точно хотите удалить черновик и опубликованное сообщение?\n Они удалятся и Вы не сможете из вернуть!", reply_markup=confirm_delete_draft())
     await callback.answer()  
 
-@router.callback_query(F.data == "delete_confirm")
-async def cb_delete_execute(callback: types.CallbackQuery):
-    draft = await get_draft(callback.from_user.id)
-    bot = callback.message.bot
+@callbacks.action(Action.DELETE_CONFIRM)
+async def cb_delete_execute(callback: types.CallbackQuery, session: AsyncSession):
+    draft = await get_draft(callback.from_user.id, session=session)
+    await delete_draft(callback.from_user.id, session=session)
+    after_commit(session, partial(cancel_expiry, draft.id))
     if not draft.is_draft:
-        await bot.delete_message(chat_id=CHAT_ID, message_id=draft.message_id)
-        if draft.theme_name:
-            await bot.delete_message(chat_id=CHAT_ID, message_id=draft.theme_message_id)
-    await delete_draft(callback.from_user.id)
+        after_commit(session, partial(enqueue_delete_post, draft.message_id, draft.theme_message_id))
+    await commit(session)
     await callback.message.answer("Черновик и опубликованное сообщение удалены ❌")
     await callback.answer()
 
 
-@router.callback_query(F.data == "delete_cancel")
+@callbacks.action(Action.DELETE_CANCEL)
 async def cb_delete_cancel(callback: types.CallbackQuery):
     await callback.message.answer("Удаление отменено ✅")
     await callback.answer()
     
-@router.callback_query(F.data == "choose_topic")
-async def cb_set_topic(callback: types.CallbackQuery):
+@callbacks.action(Action.CHOOSE_TOPIC)
+async def cb_choose_topic(callback: types.CallbackQuery):
     await callback.message.answer("Выберите тему, в которой дополнительно\nбудет публиковаться Ваша улуга. Тему менять можно только 2 раза", reply_markup=topic_keyboard())
 
-@router.callback_query(F.data.in_(["topic_web", "topic_bots", "topic_ai"]))
-async def cb_set_topic(callback: types.CallbackQuery):
-    topics = {
-        "topic_web": "web",
-        "topic_bots": "tg bots",
-        "topic_ai": "ai"
-    }
+# Имя в callback_data -> название темы в theme_list
+TOPIC_THEMES = {
+    "web": "web",
+    "bots": "tg bots",
+    "ai": "ai"
+}
 
-    draft = await get_draft(callback.from_user.id)
+
+@callbacks.factory(TopicCallback)
+async def cb_set_topic(callback: types.CallbackQuery, callback_data: TopicCallback, session: AsyncSession):
+    if callback_data.name == "cancel":
+        await callback.message.answer("Темы не выбрана ❌")
+        return
+    new_theme = TOPIC_THEMES.get(callback_data.name)
+    if new_theme is None:
+        return
+
+    draft = await get_draft(callback.from_user.id, session=session)
     if not draft:
+        await commit(session)
         await callback.message.answer("❌ Черновик не найден.")
         return
 
-    new_theme = topics[callback.data]
-
     if not draft.theme_name:
         await create_or_update_draft(
             callback.from_user.id,
             theme_name=new_theme,
-            theme_change_count=1
+            theme_change_count=1,
+            session=session
         )
+        await commit(session)
         await callback.message.answer(f"Вы выбрали тему {new_theme}✅")
 
     elif draft.theme_change_count == 1:
         await create_or_update_draft(
             callback.from_user.id,
             theme_name=new_theme,
-            theme_change_count=2
+            theme_change_count=2,
+            session=session
         )
+        await commit(session)
         await callback.message.answer(f"Вы изменили тему на {new_theme}✅")
 
     else:
+        await commit(session)
         await callback.message.answer("❌ Нельзя менять тему больше двух раз.")
         return  
 
-    draft = await get_draft(callback.from_user.id) 
-    await show_draft(callback.from_user.id, callback.message, only_draft=draft.is_draft)
+    draft = await get_draft(callback.from_user.id, session=session)
+    await show_draft(callback.from_user.id, callback.message, only_draft=draft.is_draft, session=session)
 
-        
-@router.callback_query(F.data == "topic_cancel")
-async def cb_set_topic(callback: types.CallbackQuery):
-    await callback.message.answer("Темы не выбрана ❌")    
 
     
 
@@ -443,136 +617,81 @@ async def cb_set_topic(callback: types.CallbackQuery):
 # Публикация и оплата 
 #====================
 
-@router.callback_query(F.data == "publish")
-async def cb_publish(callback: types.CallbackQuery):
-    draft = await get_draft(callback.from_user.id)
+@callbacks.action(Action.PUBLISH)
+async def cb_publish(callback: types.CallbackQuery, session: AsyncSession):
+    draft = await get_draft(callback.from_user.id, session=session)
     if not draft:
+        await commit(session)
         await callback.message.answer("Черновик не найден.")
         return
 
     if not draft.description or not draft.contact or not draft.theme_name:
+        await commit(session)
         await callback.message.answer("❌ Нужно заполнить хотя бы описание, контакт и тему!")
         return
 
-    async with async_session() as session:
-        result = await session.execute(
-            select(User).where(User.telegram_id == callback.from_user.id)
-        )
-        user = result.scalar_one_or_none()
-
-        # if not draft.paid and not user.is_first_visit:
-        #     url, payment_id = await create_payment(1, "Оплата публикации резюме", callback.from_user.id)
-        #     await create_or_update_draft(callback.from_user.id, payment_id=payment_id)
-        #     await callback.message.answer(
-        #         "Для публикации нужно оплатить 1 руб.\nПосле оплаты нажми /check",
-        #         reply_markup=payment_menu_keyboard(url)
-        #     )
-        #     return
-
-        if user.is_first_visit:
-            user.is_first_visit = False
-            await session.commit()
-            
-        avg_query = await session.execute(
-            select(func.avg(Rating.score), func.count(Rating.id))
-            .where(Rating.to_user_id == user.id)
-        )
-        avg_score, review_count = avg_query.first()
-        avg_score = round(avg_score or 0, 1)
-        review_count = review_count or 0
+    user_id = await get_user_id(callback.from_user.id, session=session)
 
-    rating_line = (
-        f"⭐️ Рейтинг: {avg_score} / ({review_count})\n\n"
-        if review_count > 0 else "Пока нет отзывов\n\n"
-    )
+    user = await session.get(User, user_id)
 
-    full_text = (
-        f"{draft.description}\n\n"
-        f"{rating_line}"
-        f"📩 [Связаться со мной](https://t.me/{draft.contact})"
-    )
+    # if not draft.paid and not user.is_first_visit:
+    #     url, payment_id = await create_payment(1, "Оплата публикации резюме", callback.from_user.id)
+    #     await create_or_update_draft(callback.from_user.id, payment_id=payment_id, payment_status="pending", session=session)
+    #     await callback.message.answer(
+    #         "Для публикации нужно оплатить 1 руб.\nПосле оплаты нажми /check",
+    #         reply_markup=payment_menu_keyboard(url)
+    #     )
+    #     return
 
-    bot = callback.message.bot
+    if user.is_first_visit:
+        user.is_first_visit = False
+    await commit(session)
 
+    # Отправка в группу идёт в воркере, результат придёт отдельным сообщением.
+    # Ключ по id нажатия: повторная доставка того же апдейта задачу не задвоит
+    chat_id = callback.message.chat.id
     if not draft.is_draft and draft.message_id:
-        success = await update_post(callback.from_user.id)
-        if success:
-            await callback.message.answer("✅ Резюме обновлено!")
-        else:
-            await callback.message.answer("❌ Ошибка при обновлении поста.")
+        await enqueue("update_post", key=f"update_post:{callback.id}",
+                      telegram_id=callback.from_user.id, chat_id=chat_id)
+        await callback.message.answer("⏳ Обновляем резюме...")
     else:
-        if draft.photo:
-            sent_main = await bot.send_photo(
-                CHAT_ID,
-                photo=draft.photo,
-                caption=full_text,
-                parse_mode="Markdown"
-            )
-            if draft.theme_name:
-                sent_thread = await bot.send_photo(
-                    CHAT_ID,
-                    photo=draft.photo,
-                    caption=full_text,
-                    parse_mode="Markdown",
-                    message_thread_id=theme_list[draft.theme_name]
-                )
-        else:
-            sent_main = await bot.send_message(
-                CHAT_ID,
-                full_text,
-                parse_mode="Markdown"
-            )
-            if draft.theme_name:
-                sent_thread = await bot.send_message(
-                    CHAT_ID,
-                    full_text,
-                    parse_mode="Markdown",
-                    message_thread_id=theme_list[draft.theme_name]
-                )
-        await create_or_update_draft(
-            callback.from_user.id,
-            message_id=sent_main.message_id,
-            theme_message_id=sent_thread.message_id,
-            is_draft=False,
-            published_at=datetime.now(timezone.utc),
-            theme_change_count=1
-        )
-
-        await callback.message.answer("✅ Резюме опубликовано! Теперь оно в разделе 'Опубликованные'.")
+        await enqueue("publish_draft", key=f"publish_draft:{callback.id}",
+                      telegram_id=callback.from_user.id, chat_id=chat_id)
+        await callback.message.answer("⏳ Публикуем резюме...")
 
 
 
 
 #=== Проверка оплаты ===
 @router.message(Command("check"))
-async def cmd_check(message: types.Message):
+async def cmd_check(message: types.Message, session: AsyncSession):
     user_id = message.from_user.id
-    draft = await get_draft(user_id)
+    draft = await get_draft(user_id, session=session)
+    await commit(session)
     if not draft or not draft.payment_id:
         await message.answer("❌ Нет активного платежа.")
         return
 
-    try:
-        if check_payment_status(draft.payment_id):
-            await create_or_update_draft(user_id, paid=True)
-            await message.answer("✅ Оплата подтверждена! Можешь публиковать резюме.")
-        else:
-            await message.answer("⏳ Оплата ещё не прошла. Попробуй через минуту.")
-    except Exception:
-        await message.answer("⚠️ Ошибка проверки оплаты. Попробуй позже.")
+    # Статус пишут уведомления ЮKassa и сверка в воркере (payments.py), API здесь не вызывается
+    if draft.paid:
+        await message.answer("✅ Оплата подтверждена! Можешь публиковать резюме.")
+    elif draft.payment_status == "canceled":
+        await message.answer("❌ Платёж отменён. Создай новый, нажав «Опубликовать».")
+    else:
+        await message.answer("⏳ Оплата ещё не прошла. Попробуй через минуту.")
 
 
 #========    
 # Рейтинг 
 #========    
-async def start_rate_flow(message: types.Message, id_key: str, state: FSMContext):
-    async with async_session() as session:
-        result = await session.execute(select(User).where(User.id_key == id_key))
-        user = result.scalar_one_or_none()
+async def start_rate_flow(message: types.Message, id_key: str, state: FSMContext, session: AsyncSession):
+    result = await session.execute(select(User).where(User.id_key == id_key))
+    user = result.scalar_one_or_none()
+    await commit(session)
 
-        if not user:
-            await message.answer("❌ Ссылка недействительна или устарела.")
-            return
+    if not user:
+        await message.answer("❌ Ссылка недействительна или устарела.")
+        return
 
     await message.answer(
         f"Ты собираешься оценить пользователя @{user.username or 'без ника'}.\n"
@@ -580,123 +699,50 @@ async def start_rate_flow(message: types.Message, id_key: str, state: FSMContext
         reply_markup=rating_keyboard(user.id)
     )
 
-@router.callback_query(F.data.regexp(r"^rate_(\d+)_(\d+)$"))
-async def cb_handle_rating(callback: types.CallbackQuery):
-    match = re.match(r"^rate_(\d+)_(\d+)$", callback.data)
-    if not match:
+@callbacks.factory(RateCallback)
+async def cb_handle_rating(callback: types.CallbackQuery, callback_data: RateCallback, session: AsyncSession):
+    target_user_id = callback_data.target_user_id
+    score = callback_data.score
+    if not 1 <= score <= 5:
         return
 
-    target_user_id = int(match.group(1))
-    score = int(match.group(2))
-
-    async with async_session() as session:
-        from_user = (await session.execute(
-            select(User).where(User.telegram_id == callback.from_user.id)
-        )).scalar_one_or_none()
-
-        if not from_user:
-            from_user = User(
-                telegram_id=callback.from_user.id,
-                username=callback.from_user.username or None,
-            )
-            session.add(from_user)
-            await session.flush()  
-
-
-        if target_user_id == from_user.id:
-            await callback.message.answer(
-                "❌ Нельзя оценить самого себя!",
-                reply_markup=main_menu_keyboard()
-            )
-            return
-
-
-        existing = (await session.execute(
-            select(Rating).where(
-                Rating.from_user_id == from_user.id,
-                Rating.to_user_id == target_user_id
-            )
-        )).scalar_one_or_none()
-
-        if existing:
-            await callback.message.answer(
-                "⚠️ Ты уже оставлял отзыв этому пользователю.",
-                reply_markup=main_menu_keyboard()
-            )
-            return
+    from_user_id = await get_user_id(callback.from_user.id, session=session)
+    if not from_user_id:
+        from_user = await register_user(callback.from_user.id, callback.from_user.username or None, session=session)
+        from_user_id = from_user.id
 
-        new_rating = Rating(
-            from_user_id=from_user.id,
-            to_user_id=target_user_id,
-            score=score
+    if target_user_id == from_user_id:
+        await commit(session)
+        await callback.message.answer(
+            "❌ Нельзя оценить самого себя!",
+            reply_markup=main_menu_keyboard()
         )
-        session.add(new_rating)
-
+        return
 
-        result = await session.execute(
-            select(User, Draft)
-            .join(Draft, Draft.user_id == User.id, isouter=True)
-            .where(User.id == target_user_id, Draft.is_draft == False)
+    stats = await add_rating(from_user_id, target_user_id, score, session=session)
+    if stats is None:
+        await commit(session)
+        await callback.message.answer(
+            "⚠️ Ты уже оставлял отзыв этому пользователю.",
+            reply_markup=main_menu_keyboard()
         )
-        row = result.first()
-        rated_user, draft = row if row else (None, None)
-
-        if rated_user:
-            rated_user.update_id_key()
-            session.add(rated_user)
-
-        await session.commit()  
-
-
-        avg_score, review_count = (await session.execute(
-            select(func.avg(Rating.score), func.count(Rating.id))
-            .where(Rating.to_user_id == target_user_id)
-        )).first()
-        avg_score = round(avg_score or 0, 1)
-        review_count = review_count or 0
+        return
 
+    rating_sum, rating_count = stats
 
-        if draft and draft.message_id:
-            bot = callback.bot
-            rating_line = f"⭐️ Рейтинг: {avg_score}/({review_count})\n\n"
-            full_text = (
-                f"{draft.description}\n\n"
-                f"{rating_line}"
-                f"📩 [Связаться со мной](https://t.me/{draft.contact})"
-            )
+    result = await session.execute(
+        select(Draft).where(Draft.user_id == target_user_id, Draft.is_draft == False)
+    )
+    draft = result.scalar_one_or_none()
+    await commit(session)
 
-            try:
-                if draft.photo:
-                    await bot.edit_message_caption(
-                        chat_id=int(os.getenv("CHAT_ID")),
-                        message_id=draft.message_id,
-                        caption=full_text,
-                        parse_mode="Markdown"
-                    )
-                    if draft.theme_message_id:
-                        await bot.edit_message_caption(
-                        chat_id=int(os.getenv("CHAT_ID")),
-                        message_id=draft.theme_message_id,
-                        caption=full_text,
-                        parse_mode="Markdown"
-                    )
-                else:
-                    await bot.edit_message_text(
-                        chat_id=int(os.getenv("CHAT_ID")),
-                        message_id=draft.message_id,
-                        text=full_text,
-                        parse_mode="Markdown"
-                    )
-                    if draft.theme_message_id:
-                        await bot.edit_message_text(
-                        chat_id=int(os.getenv("CHAT_ID")),
-                        message_id=draft.theme_message_id,
-                        text=full_text,
-                        parse_mode="Markdown"
-                    )
-            except Exception as e:
-                logging.warning(f"Не удалось обновить сообщение: {e}")
+    if draft and draft.message_id:
+        bot = callback.bot
+        full_text = render_post(draft, rating_sum, rating_count)
 
+        for message_id in (draft.message_id, draft.theme_message_id):
+            if message_id:
+                post_editor.schedule(bot, CHAT_ID, message_id, full_text, draft.photo)
 
     await callback.answer()
     await callback.message.answer(
@@ -707,4 +753,5 @@ async def cb_handle_rating(callback: types.CallbackQuery):
 
 # === Регистрация роутеров ===
 def register_handlers(dp):
+    callbacks.register(router)
     dp.include_router(router)
\ No newline at end of file
@@ -0,0 +1,272 @@
+# jobs.py
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+
+from redis.exceptions import ResponseError
+
+from db import redis_client
+from metrics import JOB_ERRORS, JOB_LATENCY, QUEUE_DEPTH, timed
+
+# Очередь фоновых задач на Redis Streams: задача подтверждается (XACK) только после
+# выполнения, поэтому падение воркера её не теряет - её заберёт другой воркер
+JOB_STREAM = "jobs"
+JOB_GROUP = "job-workers"
+DELAYED_ZSET = f"{JOB_STREAM}:delayed"          # повторы и отложенные задачи, score - время запуска
+DEAD_LETTER_STREAM = f"{JOB_STREAM}:dead"
+JOB_STREAM_MAXLEN = int(os.getenv("JOB_STREAM_MAXLEN", 100000))
+
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", 8))
+# Задачу, которую воркер взял и не подтвердил за это время, забирает другой воркер.
+# Пока задача выполняется, воркер продлевает её каждые JOB_VISIBILITY_MS / 3
+JOB_VISIBILITY_MS = int(os.getenv("JOB_VISIBILITY_MS", 5 * 60 * 1000))
+# Сколько помнить ключ идемпотентности после постановки и после выполнения
+JOB_KEY_TTL = int(os.getenv("JOB_KEY_TTL", 24 * 60 * 60))
+JOB_BACKOFF_BASE = float(os.getenv("JOB_BACKOFF_BASE", 2))
+JOB_BACKOFF_MAX = float(os.getenv("JOB_BACKOFF_MAX", 10 * 60))
+JOB_PROMOTE_INTERVAL = float(os.getenv("JOB_PROMOTE_INTERVAL", 1))
+JOB_PROMOTE_BATCH = 100
+
+# Переносит наступившие задачи из ZSET в поток одной операцией, чтобы два воркера
+# не запустили одну и ту же
+_PROMOTE_DUE = redis_client.register_script("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, job in ipairs(due) do
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[3], '*', 'job', job)
+    redis.call('ZREM', KEYS[1], job)
+end
+return #due
+""")
+
+
+class Retry(Exception):
+    """Повторить задачу позже. delay - через сколько секунд, иначе экспоненциальная задержка"""
+
+    def __init__(self, message: str = "", delay: float | None = None):
+        super().__init__(message)
+        self.delay = delay
+
+
+class JobSpec:
+    __slots__ = ("name", "handler", "max_retries", "on_dead")
+
+    def __init__(self, name: str, handler, max_retries: int, on_dead):
+        self.name = name
+        self.handler = handler
+        self.max_retries = max_retries
+        self.on_dead = on_dead
+
+
+# {имя задачи: JobSpec}. Модули с задачами должны быть импортированы в воркере
+registry = {}
+
+
+def job(name: str, max_retries: int = 5, on_dead=None):
+    """Регистрирует корутину handler(bot, **payload) как задачу name.
+    on_dead(bot, error, **payload) вызывается, когда попытки кончились"""
+    def decorator(handler):
+        registry[name] = JobSpec(name, handler, max_retries, on_dead)
+        return handler
+    return decorator
+
+
+def job_key(key: str) -> str:
+    return f"{JOB_STREAM}:key:{key}"
+
+
+async def _push(data: str, delay: float = 0):
+    if delay > 0:
+        await redis_client.zadd(DELAYED_ZSET, {data: time.time() + delay})
+    else:
+        await redis_client.xadd(JOB_STREAM, {"job": data}, maxlen=JOB_STREAM_MAXLEN, approximate=True)
+
+
+async def enqueue(name: str, *, key: str | None = None, delay: float = 0, **payload):
+    """Ставит задачу в очередь. key - ключ идемпотентности: пока задача с ним в очереди
+    или недавно выполнена, повторная постановка ничего не делает.
+    Возвращает id задачи или None, если это дубликат"""
+    if key and not await redis_client.set(job_key(key), "queued", nx=True, ex=JOB_KEY_TTL):
+        return None
+    job_id = uuid.uuid4().hex
+    data = json.dumps({"id": job_id, "name": name, "payload": payload, "attempt": 0, "key": key})
+    try:
+        await _push(data, delay)
+    except Exception:
+        if key:
+            await redis_client.delete(job_key(key))
+        raise
+    return job_id
+
+
+async def ensure_group():
+    try:
+        await redis_client.xgroup_create(JOB_STREAM, JOB_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+class JobWorker:
+    """Выполняет задачи из потока jobs, не больше concurrency одновременно.
+    Неудачная попытка уходит в DELAYED_ZSET с нарастающей задержкой,
+    после max_retries - в dead letter"""
+
+    def __init__(self, bot, concurrency: int = JOB_CONCURRENCY):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.name = f"{socket.gethostname()}-{uuid.uuid4().hex[:6]}"
+        self._running = {}      # {id записи в потоке: задача}
+
+    async def run(self):
+        await ensure_group()
+        background = [
+            asyncio.create_task(self._promote()),
+            asyncio.create_task(self._reclaim()),
+            asyncio.create_task(self._extend_claims()),
+            asyncio.create_task(self._report_depth()),
+        ]
+        logging.info(f"Воркер задач {self.name}: {sorted(registry)}, параллельно до {self.concurrency}")
+        try:
+            while True:
+                free = self.concurrency - len(self._running)
+                if free <= 0:
+                    await asyncio.wait(self._running.values(), return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                response = await redis_client.xreadgroup(
+                    JOB_GROUP, self.name, {JOB_STREAM: ">"}, count=free, block=5000
+                )
+                for _, entries in response or []:
+                    for entry_id, fields in entries:
+                        self._spawn(entry_id, fields)
+        finally:
+            # Невыполненные задачи остаются неподтверждёнными и достанутся другому воркеру
+            running = list(self._running.values())
+            for task in background + running:
+                task.cancel()
+            await asyncio.gather(*background, *running, return_exceptions=True)
+
+    def _spawn(self, entry_id, fields: dict):
+        if entry_id in self._running:
+            # Уже выполняется здесь - вторая копия не нужна
+            return
+        task = asyncio.create_task(self._handle(entry_id, fields))
+        self._running[entry_id] = task
+        task.add_done_callback(lambda _: self._running.pop(entry_id, None))
+
+    async def _handle(self, entry_id, fields: dict):
+        try:
+            job = json.loads(fields[b"job"])
+            spec = registry[job["name"]]
+        except (KeyError, TypeError, ValueError) as e:
+            logging.error(f"Непонятная задача {entry_id}: {fields}")
+            await self._bury(entry_id, fields, f"неизвестная задача: {e}")
+            return
+
+        key = job.get("key")
+        if key and await redis_client.get(job_key(key)) == b"done":
+            # Воркер выполнил задачу, но упал до XACK
+            await redis_client.xack(JOB_STREAM, JOB_GROUP, entry_id)
+            return
+
+        try:
+            with timed(JOB_LATENCY, spec.name):
+                await spec.handler(self.bot, **job["payload"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            JOB_ERRORS.labels(spec.name).inc()
+            await self._fail(entry_id, job, spec, e)
+            return
+
+        if key:
+            await redis_client.set(job_key(key), "done", ex=JOB_KEY_TTL)
+        await redis_client.xack(JOB_STREAM, JOB_GROUP, entry_id)
+
+    async def _fail(self, entry_id, job: dict, spec: JobSpec, error: Exception):
+        attempt = job["attempt"] + 1
+        if attempt > spec.max_retries:
+            logging.error(f"Задача {spec.name} ({job['id']}) не выполнена за {attempt} попыток: {error}")
+            await self._bury(entry_id, {"job": json.dumps(job)}, str(error))
+            if job.get("key"):
+                await redis_client.delete(job_key(job["key"]))
+            if spec.on_dead:
+                try:
+                    await spec.on_dead(self.bot, error, **job["payload"])
+                except Exception as e:
+                    logging.error(f"Ошибка в on_dead задачи {spec.name}: {e}")
+            return
+
+        if isinstance(error, Retry) and error.delay is not None:
+            delay = error.delay
+        else:
+            delay = min(JOB_BACKOFF_BASE * 2 ** (attempt - 1), JOB_BACKOFF_MAX)
+        log = logging.info if isinstance(error, Retry) else logging.warning
+        log(f"Задача {spec.name} ({job['id']}), попытка {attempt}: {error}. Повтор через {delay:.0f} с.")
+        await _push(json.dumps({**job, "attempt": attempt}), delay)
+        await redis_client.xack(JOB_STREAM, JOB_GROUP, entry_id)
+
+    async def _bury(self, entry_id, fields: dict, error: str):
+        await redis_client.xadd(DEAD_LETTER_STREAM, {**fields, "error": error},
+                                maxlen=JOB_STREAM_MAXLEN, approximate=True)
+        await redis_client.xack(JOB_STREAM, JOB_GROUP, entry_id)
+
+    async def _promote(self):
+        while True:
+            try:
+                while await _PROMOTE_DUE(
+                    keys=[DELAYED_ZSET, JOB_STREAM],
+                    args=[time.time(), JOB_PROMOTE_BATCH, JOB_STREAM_MAXLEN]
+                ) >= JOB_PROMOTE_BATCH:
+                    pass
+            except Exception as e:
+                logging.error(f"Не удалось перенести отложенные задачи: {e}")
+            await asyncio.sleep(JOB_PROMOTE_INTERVAL)
+
+    async def _reclaim(self):
+        """Забирает задачи упавших воркеров: взяты, но не подтверждены дольше JOB_VISIBILITY_MS"""
+        while True:
+            await asyncio.sleep(JOB_VISIBILITY_MS / 2000)
+            try:
+                free = self.concurrency - len(self._running)
+                if free <= 0:
+                    continue
+                _, entries, _ = await redis_client.xautoclaim(
+                    JOB_STREAM, JOB_GROUP, self.name, min_idle_time=JOB_VISIBILITY_MS, count=free
+                )
+                for entry_id, fields in entries:
+                    if fields:
+                        self._spawn(entry_id, fields)
+            except Exception as e:
+                logging.error(f"Не удалось забрать зависшие задачи: {e}")
+
+    async def _extend_claims(self):
+        """XCLAIM ... JUSTID сбрасывает время простоя у выполняемых задач,
+        поэтому XAUTOCLAIM других воркеров (и этого же) их не трогает"""
+        while True:
+            await asyncio.sleep(JOB_VISIBILITY_MS / 3000)
+            ids = list(self._running)
+            if not ids:
+                continue
+            try:
+                await redis_client.xclaim(
+                    JOB_STREAM, JOB_GROUP, self.name, min_idle_time=0, message_ids=ids, justid=True
+                )
+            except Exception as e:
+                logging.error(f"Не удалось продлить выполняемые задачи: {e}")
+
+    async def _report_depth(self):
+        while True:
+            try:
+                for group in await redis_client.xinfo_groups(JOB_STREAM):
+                    name = group["name"]
+                    if (name.decode() if isinstance(name, bytes) else name) == JOB_GROUP:
+                        QUEUE_DEPTH.labels(JOB_STREAM).set((group.get("lag") or 0) + (group.get("pending") or 0))
+                QUEUE_DEPTH.labels(DELAYED_ZSET).set(await redis_client.zcard(DELAYED_ZSET))
+                QUEUE_DEPTH.labels(DEAD_LETTER_STREAM).set(await redis_client.xlen(DEAD_LETTER_STREAM))
+            except Exception as e:
+                logging.warning(f"Не удалось получить длину очереди задач: {e}")
+            await asyncio.sleep(15)
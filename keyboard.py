@@ -1,17 +1,23 @@
+from functools import lru_cache
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from callbacks import Action, RateCallback, TopicCallback
+
+# Статичные клавиатуры собираются один раз и переиспользуются
+@lru_cache(maxsize=None)
 def draft_keyboard():
     kb = InlineKeyboardBuilder()
-    kb.button(text="📸 Фото", callback_data="edit_photo")
-    kb.button(text="✍️ Описание", callback_data="edit_desc")
-    kb.button(text="👤 Контакт", callback_data="edit_contact")
-    kb.button(text="📰 Темы", callback_data="choose_topic")
-    kb.button(text="💾 В черновик", callback_data="save_draft")
-    kb.button(text="❌ Удалить", callback_data="delete")
-    kb.button(text="✅ Опубликовать", callback_data="publish")
+    kb.button(text="📸 Фото", callback_data=Action.EDIT_PHOTO)
+    kb.button(text="✍️ Описание", callback_data=Action.EDIT_DESC)
+    kb.button(text="👤 Контакт", callback_data=Action.EDIT_CONTACT)
+    kb.button(text="📰 Темы", callback_data=Action.CHOOSE_TOPIC)
+    kb.button(text="💾 В черновик", callback_data=Action.SAVE_DRAFT)
+    kb.button(text="❌ Удалить", callback_data=Action.DELETE)
+    kb.button(text="✅ Опубликовать", callback_data=Action.PUBLISH)
     kb.adjust(2,2,2,1)
     return kb.as_markup()
 
+@lru_cache(maxsize=None)
 def main_menu_keyboard():
     kb = ReplyKeyboardMarkup(
         keyboard=[
@@ -39,31 +45,35 @@ def payment_menu_keyboard(url_link):
     return kb.as_markup()
 
 
+@lru_cache(maxsize=1024)
 def rating_keyboard(target_user_id: int):
     kb = InlineKeyboardBuilder()
     for i in range(1, 6):
-        kb.button(text=f"⭐️ {i}", callback_data=f"rate_{target_user_id}_{i}")
+        kb.button(text=f"⭐️ {i}", callback_data=RateCallback(target_user_id=target_user_id, score=i))
     kb.adjust(5)
     return kb.as_markup()
 
+@lru_cache(maxsize=None)
 def confirm_delete_draft():
     kb = InlineKeyboardBuilder()
-    kb.button(text="✅ Да, удалить", callback_data="delete_confirm")
-    kb.button(text="❌ Отмена", callback_data="delete_cancel")
+    kb.button(text="✅ Да, удалить", callback_data=Action.DELETE_CONFIRM)
+    kb.button(text="❌ Отмена", callback_data=Action.DELETE_CANCEL)
     return kb.as_markup()
 
+@lru_cache(maxsize=None)
 def confirm_in_draft():
     kb = InlineKeyboardBuilder()
-    kb.button(text="✅ Да, в черновик", callback_data="in_draft_confirm")
-    kb.button(text="❌ Отмена", callback_data="in_draft_cancel")
+    kb.button(text="✅ Да, в черновик", callback_data=Action.IN_DRAFT_CONFIRM)
+    kb.button(text="❌ Отмена", callback_data=Action.IN_DRAFT_CANCEL)
     return kb.as_markup()
 
 
+@lru_cache(maxsize=None)
 def topic_keyboard():
     kb = InlineKeyboardBuilder()
-    kb.button(text="💻 Web", callback_data="topic_web")
-    kb.button(text="🤖 ТГ боты", callback_data="topic_bots")
-    kb.button(text="🧠 AI", callback_data="topic_ai")
-    kb.button(text="❌ Без темы", callback_data="topic_cancel")
+    kb.button(text="💻 Web", callback_data=TopicCallback(name="web"))
+    kb.button(text="🤖 ТГ боты", callback_data=TopicCallback(name="bots"))
+    kb.button(text="🧠 AI", callback_data=TopicCallback(name="ai"))
+    kb.button(text="❌ Без темы", callback_data=TopicCallback(name="cancel"))
     kb.adjust(3,1)
     return kb.as_markup()
@@ -0,0 +1,92 @@
+# metrics.py
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Модуль не импортирует ничего из проекта, поэтому его можно подключать из db.py и остальных
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_seconds", "Время выполнения хэндлера", ["handler"]
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Исключения в хэндлерах", ["handler"]
+)
+
+DB_QUERY_LATENCY = Histogram(
+    "bot_db_query_seconds", "Время SQL-запроса", ["statement"],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+)
+DB_POOL_WAIT = Histogram(
+    "bot_db_pool_wait_seconds", "Ожидание соединения из пула",
+    buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5, 10)
+)
+
+REDIS_LATENCY = Histogram(
+    "bot_redis_command_seconds", "Время команды Redis", ["command"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .5, 1)
+)
+
+TELEGRAM_LATENCY = Histogram(
+    "bot_telegram_request_seconds", "Время запроса к Bot API", ["method"]
+)
+TELEGRAM_ERRORS = Counter(
+    "bot_telegram_errors_total", "Ошибки Bot API", ["method", "error"]
+)
+TELEGRAM_RETRY_AFTER = Counter(
+    "bot_telegram_retry_after_total", "Ответы flood control (RetryAfter)", ["method"]
+)
+RATE_LIMIT_WAIT = Histogram(
+    "bot_rate_limit_wait_seconds", "Ожидание токена в rate limiter",
+    buckets=(.001, .01, .05, .1, .5, 1, 2.5, 5, 10, 30)
+)
+
+OUTBOUND_QUEUE = Gauge(
+    "bot_outbound_queue", "Задач в полосе диспетчера отправки", ["lane"]
+)
+OUTBOUND_WAIT = Histogram(
+    "bot_outbound_wait_seconds", "Время от постановки задачи в очередь до её выполнения", ["lane"],
+    buckets=(.001, .01, .05, .1, .5, 1, 2.5, 5, 10, 30, 60)
+)
+QUEUE_DEPTH = Gauge(
+    "bot_queue_depth", "Длина очередей в Redis", ["queue"]
+)
+JOB_LATENCY = Histogram(
+    "bot_job_seconds", "Время выполнения фоновой задачи", ["job"],
+    buckets=(.01, .05, .1, .5, 1, 2.5, 5, 10, 30, 60, 300)
+)
+JOB_ERRORS = Counter(
+    "bot_job_errors_total", "Неудачные попытки фоновых задач", ["job"]
+)
+BROADCAST_MESSAGES = Counter(
+    "bot_broadcast_messages_total", "Сообщения рассылок по результату", ["result"]
+)
+STREAM_LAG = Gauge(
+    "bot_update_stream_lag", "Непрочитанные и неподтверждённые апдейты в Redis Streams", ["kind"]
+)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    """HTTP /metrics для Prometheus. METRICS_PORT=0 отключает сервер"""
+    if not port:
+        return
+    try:
+        start_http_server(port)
+        logging.info(f"Метрики доступны на :{port}/metrics")
+    except OSError as e:
+        logging.warning(f"Не удалось запустить сервер метрик на порту {port}: {e}")
+
+
+@contextmanager
+def timed(histogram, *labels):
+    """Замеряет блок и пишет длительность в histogram (с метками, если они есть)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        target = histogram.labels(*labels) if labels else histogram
+        target.observe(time.perf_counter() - start)
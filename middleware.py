@@ -1,17 +1,71 @@
 import asyncio
+import logging
 import time
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery
+from cachetools import TTLCache
+
+from db import async_session, commit, redis_client
+from metrics import HANDLER_ERRORS, HANDLER_LATENCY, timed
+
+# Один атомарный шаг анти-спама. KEYS: состояние пользователя для типа событий, бан пользователя.
+# ARGV: min_interval (мс), max_violations, ban_time (мс).
+# Возвращает {код, мс}: 0 - пропустить, 1 - предупреждение, 2 - уже забанен (сколько осталось), 3 - только что забанен
+_ANTI_SPAM = redis_client.register_script("""
+local ban_left = redis.call('PTTL', KEYS[2])
+if ban_left > 0 then
+    return {2, ban_left}
+end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local min_interval = tonumber(ARGV[1])
+local last = tonumber(redis.call('HGET', KEYS[1], 'last') or 0)
+if now - last < min_interval then
+    local violations = redis.call('HINCRBY', KEYS[1], 'violations', 1)
+    if violations >= tonumber(ARGV[2]) then
+        redis.call('SET', KEYS[2], 1, 'PX', ARGV[3])
+        redis.call('HSET', KEYS[1], 'violations', 0)
+        return {3, tonumber(ARGV[3])}
+    end
+    return {1, 0}
+end
+-- После min_interval любое событие проходит и обнуляет нарушения, так что дольше хранить незачем
+redis.call('HSET', KEYS[1], 'last', now, 'violations', 0)
+redis.call('PEXPIRE', KEYS[1], min_interval)
+return {0, 0}
+""")
+
 
 class AntiSpamMiddleware(BaseMiddleware):
-    def __init__(self, min_interval: float = 1.0, max_violations: int = 3, ban_time: int = 10):
+    """Ограничение частоты для одного типа событий (kind), состояние хранится в Redis
+    и общее для всех процессов. Бан общий для всех типов событий пользователя"""
+
+    def __init__(self, kind: str = "event", min_interval: float = 1.0, max_violations: int = 3, ban_time: int = 10):
+        self.kind = kind
         self.min_interval = min_interval       # Минимальный интервал между нажатиями
         self.max_violations = max_violations   # Сколько раз можно "спамить" до блокировки
         self.ban_time = ban_time               # Время блокировки в секундах
 
-        self._last_action_time = {}   # {user_id: timestamp}
-        self._violations = {}         # {user_id: кол-во нарушений}
-        self._banned_until = {}       # {user_id: timestamp до какого момента забанен}
+        # Уже забаненные отсекаются без похода в Redis: {user_id: monotonic-время конца бана}
+        self._banned_until = TTLCache(maxsize=10000, ttl=ban_time)
+
+    async def _check(self, user_id: int):
+        banned_until = self._banned_until.get(user_id)
+        if banned_until is not None and time.monotonic() < banned_until:
+            return 2, int((banned_until - time.monotonic()) * 1000)
+
+        try:
+            code, ms = await _ANTI_SPAM(
+                keys=[f"spam:{self.kind}:{user_id}", f"spam:ban:{user_id}"],
+                args=[int(self.min_interval * 1000), self.max_violations, self.ban_time * 1000]
+            )
+        except Exception as e:
+            logging.warning(f"Анти-спам в Redis недоступен, пропускаем событие: {e}")
+            return 0, 0
+
+        if code in (2, 3):
+            self._banned_until[user_id] = time.monotonic() + ms / 1000
+        return code, ms
 
     async def __call__(self, handler, event, data):
         user_id = None
@@ -24,43 +78,59 @@ class AntiSpamMiddleware(BaseMiddleware):
         if user_id is None:
             return await handler(event, data)
 
-        now = time.monotonic()
+        code, ms = await self._check(user_id)
 
-        # Проверяем, не забанен ли пользователь
-        banned_until = self._banned_until.get(user_id, 0)
-        if now < banned_until:
-            remaining = int(banned_until - now)
+        # Пользователь забанен
+        if code == 2:
+            remaining = ms // 1000
             if isinstance(event, CallbackQuery):
                 await event.answer(f"🚫 Подожди {remaining} с.", show_alert=False)
             elif isinstance(event, Message):
                 await event.answer(f"🚫 Ты слишком часто пишешь! Подожди {remaining} секунд.")
             return
 
-        # Проверяем частоту
-        last_time = self._last_action_time.get(user_id, 0)
-        if now - last_time < self.min_interval:
-            # Засчитываем нарушение
-            self._violations[user_id] = self._violations.get(user_id, 0) + 1
-
-            # Если превышено количество нарушений — баним
-            if self._violations[user_id] >= self.max_violations:
-                self._banned_until[user_id] = now + self.ban_time
-                self._violations[user_id] = 0
-                if isinstance(event, CallbackQuery):
-                    await event.answer(f"⛔ Слишком часто! Блокировка на {self.ban_time} секунд.", show_alert=True)
-                elif isinstance(event, Message):
-                    await event.answer(f"⛔ Ты слишком активен! Заблокирован на {self.ban_time} секунд.")
-                return
-
-            # Просто предупреждение
+        # Превышено количество нарушений — бан
+        if code == 3:
+            if isinstance(event, CallbackQuery):
+                await event.answer(f"⛔ Слишком часто! Блокировка на {self.ban_time} секунд.", show_alert=True)
+            elif isinstance(event, Message):
+                await event.answer(f"⛔ Ты слишком активен! Заблокирован на {self.ban_time} секунд.")
+            return
+
+        # Просто предупреждение
+        if code == 1:
             if isinstance(event, CallbackQuery):
                 await event.answer("⏳ Не так быстро!", show_alert=False)
             elif isinstance(event, Message):
                 await event.answer("⏳ Не так быстро!")
             return
 
-        # Всё ок — обновляем время последнего действия и обнуляем нарушения
-        self._last_action_time[user_id] = now
-        self._violations[user_id] = 0
-
         return await handler(event, data)
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Одна сессия БД на апдейт: хендлеры получают её как session и передают в сервисы.
+    Хендлер коммитит сам (db.commit) перед вызовами Telegram, чтобы ожидание лимитов
+    не держало соединение и блокировки строк. Коммит здесь закрывает то, что осталось"""
+
+    async def __call__(self, handler, event, data):
+        async with async_session() as session:
+            data["session"] = session
+            result = await handler(event, data)
+            await commit(session)
+            logging.debug(f"Апдейт обработан, соединений из пула: {session.info.get('checkouts', 0)}")
+            return result
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Гистограмма времени по каждому хэндлеру (вешается как inner middleware)"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else type(event).__name__
+        try:
+            with timed(HANDLER_LATENCY, name):
+                return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
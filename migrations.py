@@ -0,0 +1,137 @@
+# migrations.py
+import asyncio
+import json
+import logging
+import sys
+from datetime import datetime, timezone
+
+from sqlalchemy import func, select, text
+
+from db import engine, Base, Draft, Rating, User
+
+# Ревизии применяются по порядку и записываются в schema_version.
+# create_all на пустой базе уже создаёт всё по моделям, поэтому каждая
+# инструкция должна быть идемпотентной (IF NOT EXISTS и т.п.)
+REVISIONS = [
+    (1, "rating aggregates and one draft per user", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS rating_sum INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS rating_count INTEGER NOT NULL DEFAULT 0",
+        # Агрегаты для уже выставленных оценок, иначе у старых пользователей рейтинг обнулится.
+        # Пересчёт целиком, поэтому повторный запуск даёт тот же результат
+        "UPDATE users SET rating_sum = s.total, rating_count = s.cnt "
+        "FROM (SELECT to_user_id, sum(score) AS total, count(*) AS cnt FROM ratings GROUP BY to_user_id) s "
+        "WHERE users.id = s.to_user_id",
+        # Перед уникальным индексом оставляем только самый свежий черновик пользователя
+        "DELETE FROM drafts older USING drafts newer WHERE older.user_id = newer.user_id AND older.id < newer.id",
+        # Он же индекс для get_draft / create_or_update_draft по user_id
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_drafts_user_id ON drafts (user_id)",
+    ]),
+    (2, "index ratings by recipient", [
+        "CREATE INDEX IF NOT EXISTS ix_ratings_to_user_id ON ratings (to_user_id)",
+    ]),
+    (3, "expires_at for published drafts", [
+        "ALTER TABLE drafts ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ",
+        "UPDATE drafts SET expires_at = published_at + INTERVAL '30 days' "
+        "WHERE is_draft = false AND published_at IS NOT NULL AND expires_at IS NULL",
+        # В индексе только опубликованные посты - их на порядки меньше, чем черновиков
+        "CREATE INDEX IF NOT EXISTS ix_drafts_expires_at ON drafts (expires_at) WHERE is_draft = false",
+    ]),
+    (4, "payment status from notifications", [
+        "ALTER TABLE drafts ADD COLUMN IF NOT EXISTS payment_status TEXT",
+        "CREATE INDEX IF NOT EXISTS ix_drafts_payment_id ON drafts (payment_id) WHERE payment_id IS NOT NULL",
+    ]),
+    (5, "mark users who blocked the bot", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN NOT NULL DEFAULT false",
+    ]),
+]
+
+# Ключ pg_advisory_xact_lock: несколько реплик при старте не накатывают миграции одновременно
+MIGRATION_LOCK_ID = 7271001
+
+
+async def migrate():
+    """Создаёт недостающие таблицы и применяет новые ревизии в одной транзакции"""
+    async with engine.begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, name TEXT NOT NULL, "
+            "applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+        ))
+        await conn.run_sync(Base.metadata.create_all)
+        current = (await conn.execute(text("SELECT max(version) FROM schema_version"))).scalar() or 0
+
+        for version, name, statements in REVISIONS:
+            if version <= current:
+                continue
+            for statement in statements:
+                await conn.execute(text(statement))
+            await conn.execute(
+                text("INSERT INTO schema_version (version, name) VALUES (:version, :name)"),
+                {"version": version, "name": name}
+            )
+            logging.info(f"Применена миграция {version}: {name}")
+
+
+def hot_queries():
+    """(название, запрос, индекс, которым он должен читаться) - горячие запросы services.py и tasks.py"""
+    from tasks import _expired
+
+    now = datetime.now(timezone.utc)
+    return [
+        ("get_user_id", select(User.id).where(User.telegram_id == 1), "users_telegram_id_key"),
+        ("get_draft", select(*Draft.__table__.columns).where(Draft.user_id == 1), "uq_drafts_user_id"),
+        (
+            "rating totals",
+            select(func.sum(Rating.score), func.count(Rating.id)).where(Rating.to_user_id == 1),
+            "ix_ratings_to_user_id"
+        ),
+        (
+            "expire_posts",
+            select(Draft.id).where(_expired(now)).order_by(Draft.expires_at).limit(500),
+            "ix_drafts_expires_at"
+        ),
+        (
+            "apply_payment_status",
+            select(Draft.id).where(Draft.payment_id == "payment"),
+            "ix_drafts_payment_id"
+        ),
+    ]
+
+
+def _index_names(plan: dict):
+    if "Index Name" in plan:
+        yield plan["Index Name"]
+    for child in plan.get("Plans", []):
+        yield from _index_names(child)
+
+
+async def check_indexes() -> bool:
+    """EXPLAIN горячих запросов: проверяет, что у каждого есть план с нужным индексом.
+    Seq scan отключается, потому что на маленькой базе он дешевле любого индекса"""
+    ok = True
+    async with engine.connect() as conn:
+        await conn.execute(text("SET enable_seqscan = off"))
+        for name, query, index in hot_queries():
+            compiled = query.compile(dialect=conn.dialect)
+            params = tuple(compiled.params[key] for key in compiled.positiontup)
+            result = await conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled.string}", params)
+            plan = result.scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            used = set(_index_names(plan[0]["Plan"]))
+            if index in used:
+                print(f"✅ {name}: {index}")
+            else:
+                ok = False
+                print(f"❌ {name}: ожидался {index}, в плане {sorted(used) or 'нет индексов'}")
+    return ok
+
+
+if __name__ == "__main__":
+    # python migrations.py - применить миграции, python migrations.py check - проверить индексы
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["check"]:
+        sys.exit(0 if asyncio.run(check_indexes()) else 1)
+    asyncio.run(migrate())
+    print("База данных и таблицы созданы!")
@@ -0,0 +1,248 @@
+# outbound.py
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import deque
+from functools import partial
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramBadRequest
+from aiogram.types import InputMediaPhoto
+
+from db import redis_client
+from metrics import OUTBOUND_QUEUE, OUTBOUND_WAIT
+
+# Полосы очереди: чем меньше номер, тем выше приоритет
+HIGH = 0    # ответы пользователю в личном чате
+LOW = 1     # публикация, правка и удаление постов в группе
+
+_background = set()     # ссылки на отложенные постановки и сбросы правок, чтобы их не собрал GC
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    task.add_done_callback(_log_background_error)
+
+
+class OutboundJob:
+    __slots__ = ("call", "lane", "key", "future", "attempts", "queued_at")
+
+    def __init__(self, call, lane: int, key):
+        self.call = call
+        self.lane = lane
+        self.key = key
+        self.future = asyncio.get_running_loop().create_future()
+        self.attempts = 0
+        self.queued_at = 0.0
+
+
+class OutboundDispatcher:
+    """Асинхронная отправка в Telegram с приоритетными полосами.
+    Полосы ограничены по размеру (submit ждёт, если полоса заполнена),
+    TelegramRetryAfter переносит задачу на указанное время, а задачи с одним key
+    (например, (chat_id, message_id)) выполняются строго по порядку.
+    У каждой полосы свои воркеры: ожидание токенов rate limiter идёт внутри вызова,
+    и LOW-задачи, ждущие лимита группы, не должны занимать воркеров для ответов пользователям"""
+
+    def __init__(self, workers: int = 4, high_workers: int = 2, lane_size: int = 1000, max_retries: int = 5):
+        self.workers = workers                  # воркеры полосы LOW
+        self.high_workers = high_workers        # воркеры полосы HIGH
+        self.max_retries = max_retries
+        self._lanes = {HIGH: asyncio.Queue(lane_size), LOW: asyncio.Queue(lane_size)}
+        self._keys = {}                         # {key: deque задач, ждущих предыдущую}
+        self._tasks = []
+        for lane, name in ((HIGH, "high"), (LOW, "low")):
+            OUTBOUND_QUEUE.labels(name).set_function(self._lanes[lane].qsize)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [
+            *(asyncio.create_task(self._worker(HIGH)) for _ in range(self.high_workers)),
+            *(asyncio.create_task(self._worker(LOW)) for _ in range(self.workers)),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def qsize(self, lane: int) -> int:
+        return self._lanes[lane].qsize()
+
+    async def submit(self, call, lane: int = LOW, key=None) -> asyncio.Future:
+        """Ставит вызов call() в очередь и возвращает Future с его результатом.
+        Результат можно не ждать: ошибки после всех повторов попадут в лог"""
+        self.start()
+        job = OutboundJob(call, lane, key)
+        job.future.add_done_callback(_log_failure)
+        if key is not None:
+            if key in self._keys:
+                # По этому ключу уже что-то выполняется - встаём за ним
+                self._keys[key].append(job)
+                return job.future
+            self._keys[key] = deque()
+        await self._put(job)
+        return job.future
+
+    async def call(self, call, lane: int = LOW, key=None):
+        """submit + ожидание результата"""
+        return await (await self.submit(call, lane, key))
+
+    async def _put(self, job: OutboundJob):
+        job.queued_at = time.perf_counter()
+        await self._lanes[job.lane].put(job)
+
+    def _put_later(self, job: OutboundJob, delay: float = 0):
+        loop = asyncio.get_running_loop()
+        loop.call_later(delay, lambda: _spawn(self._put(job)))
+
+    async def _worker(self, lane: int):
+        queue = self._lanes[lane]
+        while True:
+            job = await queue.get()
+            OUTBOUND_WAIT.labels("high" if job.lane == HIGH else "low").observe(time.perf_counter() - job.queued_at)
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка в диспетчере отправки: {e}")
+
+    async def _run(self, job: OutboundJob):
+        job.attempts += 1
+        try:
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            # Ключ остаётся занятым, поэтому следующие задачи по нему не обгонят эту
+            logging.warning(f"Flood control, повтор через {e.retry_after} с.")
+            self._put_later(job, e.retry_after)
+            return
+        except (TelegramNetworkError, TelegramServerError) as e:
+            if job.attempts < self.max_retries:
+                self._put_later(job, min(2 ** job.attempts, 30))
+                return
+            self._finish(job, error=e)
+            return
+        except Exception as e:
+            self._finish(job, error=e)
+            return
+        self._finish(job, result=result)
+
+    def _finish(self, job: OutboundJob, result=None, error=None):
+        if not job.future.done():
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+
+        if job.key is None:
+            return
+        waiting = self._keys.get(job.key)
+        if waiting:
+            _spawn(self._put(waiting.popleft()))
+        else:
+            self._keys.pop(job.key, None)
+
+
+def _log_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception():
+        logging.error(f"Не удалось выполнить запрос к Telegram: {future.exception()}")
+
+
+def _log_background_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logging.error(f"Ошибка фоновой задачи диспетчера отправки: {task.exception()}")
+
+
+outbound = OutboundDispatcher(
+    workers=int(os.getenv("OUTBOUND_WORKERS", 4)),
+    high_workers=int(os.getenv("OUTBOUND_HIGH_WORKERS", 2)),
+    lane_size=int(os.getenv("OUTBOUND_LANE_SIZE", 1000))
+)
+
+
+# --- Склеивание правок опубликованных постов ---
+POST_EDIT_WINDOW = float(os.getenv("POST_EDIT_WINDOW", 3))
+POST_STATE_TTL = 31 * 24 * 60 * 60
+
+
+def content_hash(text: str, photo: str | None = None) -> str:
+    """Хеш того, что видно в посте. Та же идея, что и Draft.last_hash"""
+    return hashlib.md5(f"{text}\x1f{photo or ''}".encode()).hexdigest()
+
+
+class EditScheduler:
+    """Копит правки сообщения (chat_id, message_id) в течение window секунд и отправляет
+    только последнюю. Если отрисованный пост совпадает с уже отправленным, вызова нет вовсе"""
+
+    def __init__(self, dispatcher: OutboundDispatcher, window: float = POST_EDIT_WINDOW):
+        self.dispatcher = dispatcher
+        self.window = window
+        self._pending = {}      # {(chat_id, message_id): (bot, text, photo)}
+
+    @staticmethod
+    def _state_key(chat_id, message_id) -> str:
+        return f"post_state:{chat_id}:{message_id}"
+
+    def schedule(self, bot, chat_id, message_id: int, text: str, photo: str | None = None):
+        key = (chat_id, message_id)
+        first = key not in self._pending
+        self._pending[key] = (bot, text, photo)
+        if first:
+            loop = asyncio.get_running_loop()
+            loop.call_later(self.window, lambda: _spawn(self._flush(key)))
+
+    def cancel(self, chat_id, message_id: int):
+        """Отменяет ждущую правку (например, сообщение удаляется)"""
+        self._pending.pop((chat_id, message_id), None)
+
+    async def remember(self, chat_id, message_id: int, text: str, photo: str | None = None):
+        """Запоминает, что сейчас показано в сообщении (вызывается после отправки)"""
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(self._state_key(chat_id, message_id), mapping={
+                "hash": content_hash(text, photo),
+                "photo": photo or ""
+            })
+            pipe.expire(self._state_key(chat_id, message_id), POST_STATE_TTL)
+            await pipe.execute()
+
+    async def _flush(self, key):
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        bot, text, photo = pending
+        chat_id, message_id = key
+        try:
+            state = await redis_client.hgetall(self._state_key(chat_id, message_id))
+            if state.get(b"hash", b"").decode() == content_hash(text, photo):
+                return
+
+            if photo and state.get(b"photo", b"").decode() == photo:
+                # Фото то же - достаточно поменять подпись
+                call = partial(bot.edit_message_caption, chat_id=chat_id, message_id=message_id,
+                               caption=text, parse_mode="Markdown")
+            elif photo:
+                media = InputMediaPhoto(media=photo, caption=text, parse_mode="Markdown")
+                call = partial(bot.edit_message_media, chat_id=chat_id, message_id=message_id, media=media)
+            else:
+                call = partial(bot.edit_message_text, chat_id=chat_id, message_id=message_id,
+                               text=text, parse_mode="Markdown")
+            await self.dispatcher.submit(partial(self._edit, call, chat_id, message_id, text, photo), key=key)
+        except Exception as e:
+            logging.error(f"Не удалось запланировать правку сообщения {message_id}: {e}")
+
+    async def _edit(self, call, chat_id, message_id, text, photo):
+        try:
+            await call()
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+        await self.remember(chat_id, message_id, text, photo)
+
+
+post_editor = EditScheduler(outbound)
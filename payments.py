@@ -0,0 +1,179 @@
+# payments.py
+import asyncio
+import ipaddress
+import logging
+import os
+import time
+from functools import partial
+
+from aiohttp import web
+from sqlalchemy import or_, select, update
+
+from db import async_session, Draft, User
+from jobs import job, enqueue
+from outbound import outbound, HIGH
+from services import invalidate_draft_cache
+from services_payment import get_payment_status, PaymentError
+
+# Уведомления ЮKassa о платежах. Статус хранится в drafts.payment_status,
+# поэтому /check и проверка перед публикацией читают его из кеша черновика
+PAYMENT_WEBHOOK_PATH = os.getenv("PAYMENT_WEBHOOK_PATH", "/yookassa")
+# Адреса, с которых ЮKassa шлёт уведомления. Пустая строка отключает проверку (например, за прокси)
+PAYMENT_NOTIFY_IPS = os.getenv(
+    "PAYMENT_NOTIFY_IPS",
+    "185.71.76.0/27,185.71.77.0/27,77.75.153.0/25,77.75.156.11/32,77.75.156.35/32,77.75.154.128/25,2a02:5180::/32"
+)
+PAYMENT_RECONCILE_INTERVAL = int(os.getenv("PAYMENT_RECONCILE_INTERVAL", 15 * 60))
+PAYMENT_RECONCILE_BATCH = int(os.getenv("PAYMENT_RECONCILE_BATCH", 100))
+PAYMENT_RECONCILE_CONCURRENCY = 5
+
+# После этих статусов платёж больше не меняется
+FINAL_STATUSES = ("succeeded", "canceled")
+
+_allowed_networks = [ipaddress.ip_network(net.strip()) for net in PAYMENT_NOTIFY_IPS.split(",") if net.strip()]
+
+
+def _allowed(remote: str | None) -> bool:
+    if not _allowed_networks:
+        return True
+    try:
+        address = ipaddress.ip_address(remote)
+    except (TypeError, ValueError):
+        return False
+    return any(address in network for network in _allowed_networks)
+
+
+def _status_transition(status: str):
+    """Условия UPDATE для перехода к status: из финального статуса не выходим,
+    повтор того же статуса ничего не меняет"""
+    return (
+        or_(Draft.payment_status == None, Draft.payment_status.notin_(FINAL_STATUSES)),
+        Draft.payment_status.is_distinct_from(status),
+    )
+
+
+async def apply_payment_status(bot, payment_id: str, status: str) -> bool:
+    """Записывает статус платежа по drafts.payment_id. Повтор того же статуса и откат
+    из финального ничего не меняют, поэтому вызов можно повторять.
+    Возвращает True, если статус изменился"""
+    values = {"payment_status": status}
+    if status == "succeeded":
+        values["paid"] = True
+    async with async_session() as session:
+        result = await session.execute(
+            update(Draft)
+            .where(
+                Draft.payment_id == payment_id,
+                User.id == Draft.user_id,
+                *_status_transition(status)
+            )
+            .values(**values)
+            .returning(User.telegram_id)
+        )
+        telegram_ids = result.scalars().all()
+        await session.commit()
+
+    if not telegram_ids:
+        return False
+    await invalidate_draft_cache(*telegram_ids)
+    logging.info(f"Платёж {payment_id}: статус {status}")
+    if status == "succeeded":
+        for telegram_id in telegram_ids:
+            await outbound.submit(
+                partial(bot.send_message, chat_id=telegram_id, text="✅ Оплата подтверждена! Можешь публиковать резюме."),
+                lane=HIGH
+            )
+    return True
+
+
+async def handle_notification(request: web.Request, bot) -> web.Response:
+    if not _allowed(request.remote):
+        logging.warning(f"Уведомление о платеже с чужого адреса {request.remote}")
+        return web.Response(status=403)
+    try:
+        body = await request.json()
+        payment_id = body["object"]["id"]
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400)
+
+    # Тело уведомления не подписано: статус берём из API, а не из него
+    try:
+        status = await get_payment_status(payment_id)
+        await apply_payment_status(bot, payment_id, status)
+    except Exception as e:
+        # Не 200 - ЮKassa повторит уведомление позже
+        logging.error(f"Не удалось обработать уведомление о платеже {payment_id}: {e}")
+        return web.Response(status=500)
+    return web.Response(status=200)
+
+
+def setup_payment_routes(app: web.Application, bot):
+    async def notification(request):
+        return await handle_notification(request, bot)
+
+    app.router.add_post(PAYMENT_WEBHOOK_PATH, notification)
+
+
+async def run_payment_server(bot, host: str, port: int):
+    """Отдельный сервер для уведомлений, когда бот работает через polling"""
+    app = web.Application()
+    setup_payment_routes(app, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Уведомления о платежах принимаются на {host}:{port}{PAYMENT_WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+@job("reconcile_payments", max_retries=2)
+async def job_reconcile_payments(bot):
+    """Сверка незавершённых платежей с API - на случай потерянных уведомлений"""
+    semaphore = asyncio.Semaphore(PAYMENT_RECONCILE_CONCURRENCY)
+    last_id = 0
+    checked = changed = 0
+
+    async def reconcile(payment_id: str):
+        async with semaphore:
+            try:
+                return await apply_payment_status(bot, payment_id, await get_payment_status(payment_id))
+            except PaymentError as e:
+                logging.warning(f"Сверка платежа {payment_id} не удалась: {e}")
+                return False
+
+    while True:
+        async with async_session() as session:
+            result = await session.execute(
+                select(Draft.id, Draft.payment_id)
+                .where(
+                    Draft.id > last_id,
+                    Draft.payment_id != None,
+                    Draft.paid == False,
+                    or_(Draft.payment_status == None, Draft.payment_status.notin_(FINAL_STATUSES))
+                )
+                .order_by(Draft.id)
+                .limit(PAYMENT_RECONCILE_BATCH)
+            )
+            rows = result.all()
+        if not rows:
+            break
+        results = await asyncio.gather(*(reconcile(row.payment_id) for row in rows))
+        checked += len(rows)
+        changed += sum(results)
+        last_id = rows[-1].id
+
+    if checked:
+        logging.info(f"Сверка платежей: проверено {checked}, обновлено {changed}")
+
+
+async def schedule_reconciliation():
+    """Раз в PAYMENT_RECONCILE_INTERVAL ставит сверку в очередь, одну на окно для всех воркеров"""
+    while True:
+        try:
+            window = int(time.time() // PAYMENT_RECONCILE_INTERVAL)
+            await enqueue("reconcile_payments", key=f"reconcile_payments:{window}")
+        except Exception as e:
+            logging.error(f"Не удалось поставить сверку платежей: {e}")
+        await asyncio.sleep(PAYMENT_RECONCILE_INTERVAL)
@@ -0,0 +1,170 @@
+# ratelimit.py
+import asyncio
+import logging
+import os
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from cachetools import TTLCache
+from dotenv import load_dotenv
+
+from db import redis_client
+from metrics import RATE_LIMIT_WAIT, TELEGRAM_ERRORS, TELEGRAM_LATENCY, TELEGRAM_RETRY_AFTER, timed
+
+load_dotenv()
+
+# Лимиты Telegram: (токенов в секунду, ёмкость ведра)
+GLOBAL_LIMIT = (float(os.getenv("TG_GLOBAL_RATE", 30)), 30)
+GROUP_LIMIT = (20 / 60, 20)       # группы: ~20 сообщений в минуту
+PRIVATE_LIMIT = (1.0, 1)          # личные чаты: 1 сообщение в секунду
+# Правка и удаление уже отправленных сообщений не тратят лимит отправки чата,
+# но и без ограничения их не шлём: отдельное ведро на чат
+MODIFY_LIMIT = (float(os.getenv("TG_MODIFY_RATE", 3)), 30)
+
+# Методы, которые создают новые сообщения и подчиняются лимиту отправки в чат
+SEND_METHODS = {"CopyMessage", "CopyMessages", "ForwardMessage", "ForwardMessages"}
+
+# Методы, которые не отправляют сообщений и не должны ждать в очереди
+UNLIMITED_METHODS = {
+    "GetUpdates", "GetMe", "GetFile", "SetWebhook", "DeleteWebhook",
+    "GetWebhookInfo", "AnswerCallbackQuery"
+}
+
+# Атомарно проверяет и списывает по токену из всех переданных вёдер.
+# ARGV: пары (токенов в миллисекунду, ёмкость) для каждого ключа.
+# Возвращает 0, если токены списаны, иначе сколько миллисекунд подождать
+_TOKEN_BUCKET = redis_client.register_script("""
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local capacity = tonumber(ARGV[i * 2])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local current = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    current = math.min(capacity, current + (now - ts) * rate)
+    if current < 1 then
+        wait = math.max(wait, math.ceil((1 - current) / rate))
+    end
+    tokens[i] = current
+end
+if wait > 0 then
+    return wait
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local capacity = tonumber(ARGV[i * 2])
+    redis.call('HSET', key, 'tokens', tokens[i] - 1, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(capacity / rate) + 1000)
+end
+return 0
+""")
+
+
+class LocalBucket:
+    """Ведро токенов в памяти процесса: быстрый путь без похода в Redis"""
+    __slots__ = ("rate", "capacity", "tokens", "ts")
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.ts = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    def wait_time(self) -> float:
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class TelegramRateLimiter:
+    """Распределённый token bucket: общее ведро бота и по ведру на чат.
+    Состояние живёт в Redis, поэтому лимит общий для bot.py и worker.py"""
+
+    def __init__(self, prefix: str = "tg_bucket"):
+        self.prefix = prefix
+        self._local = TTLCache(maxsize=10000, ttl=600)
+
+    def _limits(self, chat_id, method: str | None = None):
+        limits = [("global", GLOBAL_LIMIT)]
+        if chat_id is None:
+            return limits
+        if method is None or method.startswith("Send") or method in SEND_METHODS:
+            # Положительные id - личные чаты, отрицательные и @username - группы и каналы (в т.ч. CHAT_ID)
+            private = isinstance(chat_id, int) and chat_id > 0
+            limits.append((f"chat:{chat_id}", PRIVATE_LIMIT if private else GROUP_LIMIT))
+        else:
+            # EditMessage*, DeleteMessage и т.п.
+            limits.append((f"modify:{chat_id}", MODIFY_LIMIT))
+        return limits
+
+    def _local_bucket(self, name: str, limit) -> LocalBucket:
+        bucket = self._local.get(name)
+        if bucket is None:
+            bucket = self._local[name] = LocalBucket(*limit)
+        return bucket
+
+    async def acquire(self, chat_id=None, method: str | None = None):
+        """Ждёт, пока в общем ведре и в ведре чата появится токен, и списывает его.
+        method - имя метода Bot API: от него зависит, какое ведро чата используется"""
+        limits = self._limits(chat_id, method)
+        local_buckets = [self._local_bucket(name, limit) for name, limit in limits]
+        keys = [f"{self.prefix}:{name}" for name, _ in limits]
+        # В скрипте время в миллисекундах
+        args = [value for _, (rate, capacity) in limits for value in (rate / 1000, capacity)]
+
+        while True:
+            # Если даже локально токенов нет, в Redis их точно нет
+            wait = max(bucket.wait_time() for bucket in local_buckets)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            try:
+                wait_ms = await _TOKEN_BUCKET(keys=keys, args=args)
+            except Exception as e:
+                logging.warning(f"Rate limiter в Redis недоступен, работаем по локальному лимиту: {e}")
+                wait_ms = 0
+
+            if not wait_ms:
+                for bucket in local_buckets:
+                    bucket.consume()
+                return
+            await asyncio.sleep(wait_ms / 1000)
+
+
+rate_limiter = TelegramRateLimiter()
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Пропускает каждый исходящий вызов Bot API через общий rate limiter
+    и пишет в метрики ожидание, время запроса и ошибки"""
+
+    def __init__(self, limiter: TelegramRateLimiter = rate_limiter):
+        self.limiter = limiter
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        if name not in UNLIMITED_METHODS:
+            with timed(RATE_LIMIT_WAIT):
+                await self.limiter.acquire(getattr(method, "chat_id", None), name)
+        try:
+            with timed(TELEGRAM_LATENCY, name):
+                return await make_request(bot, method)
+        except TelegramRetryAfter:
+            TELEGRAM_RETRY_AFTER.labels(name).inc()
+            raise
+        except TelegramAPIError as e:
+            TELEGRAM_ERRORS.labels(name, type(e).__name__).inc()
+            raise
@@ -0,0 +1,109 @@
+# render.py
+import os
+from datetime import datetime, timezone
+
+from cachetools import LRUCache
+
+from services import rating_average, calculate_draft_hash
+
+# Готовые тексты. Ключ включает last_hash черновика и версию рейтинга,
+# поэтому устаревшая запись просто перестаёт запрашиваться и вытесняется
+render_cache = LRUCache(maxsize=int(os.getenv("RENDER_CACHE_SIZE", 5000)))
+
+# Ссылки на сообщения в группе
+GROUP_LINK = "https://t.me/SkillFlows"
+BOT_LINK = "https://t.me/ITvacancyCreate_bot"
+
+theme_list = {
+    "web": 12,
+    "tg bots": 5,
+    "ai": 159
+}
+
+
+def _content_key(draft) -> str:
+    # У старых строк last_hash может быть пустым
+    return draft.last_hash or calculate_draft_hash(draft)
+
+
+def _memoize(key, build):
+    text = render_cache.get(key)
+    if text is None:
+        text = render_cache[key] = build()
+    return text
+
+
+def rating_line(rating_sum: int, rating_count: int) -> str:
+    if not rating_count:
+        return "Пока нет отзывов\n\n"
+    return f"⭐️ Рейтинг: {round(rating_average(rating_sum, rating_count), 1)} / ({rating_count})\n\n"
+
+
+def render_post(draft, rating_sum: int, rating_count: int) -> str:
+    """Текст поста в группе (Markdown)"""
+    def build():
+        text = (
+            f"{draft.description or '(нет описания)'}\n\n"
+            f"{rating_line(rating_sum, rating_count)}"
+        )
+        if draft.contact:
+            text += f"📩 [Связаться со мной](https://t.me/{draft.contact})"
+        return text
+
+    return _memoize(("post", _content_key(draft), rating_sum, rating_count), build)
+
+
+def _expiry_line(draft) -> str:
+    # Меняется каждую минуту, поэтому в кеш не попадает
+    if not draft.expires_at or draft.is_draft:
+        return ""
+    remaining = draft.expires_at - datetime.now(timezone.utc)
+    if remaining.total_seconds() <= 0:
+        return "⏳ Срок публикации истёк!\n"
+    hours = remaining.seconds // 3600
+    minutes = (remaining.seconds % 3600) // 60
+    return f"⏳ Осталось до окончания: {remaining.days} дн. {hours} ч. {minutes} мин.\n"
+
+
+def render_draft_card(draft) -> str:
+    """Карточка черновика или опубликованной услуги в личном чате (Markdown)"""
+    def build():
+        text = "📰 *Твой черновик*\n" + "─" * 30 + "\n"
+        if not draft.is_draft and draft.message_id:
+            text += f"🔗 *Главная ссылка*: {GROUP_LINK}/1/{draft.message_id}\n"
+            if draft.theme_message_id:
+                text += f"🔗 *Тематическая ссылка*: {GROUP_LINK}/{theme_list[draft.theme_name]}/{draft.theme_message_id}\n\n"
+        text += f"✍️ *Описание:*\n{draft.description or '(не заполнено)'}\n\n"
+        text += f"👤 *Контакт:* @{draft.contact or '(не заполнено)'}\n"
+        text += f"📔 *Тема:* {draft.theme_name or '(темы нет)'}\n\n"
+        return text
+
+    # last_hash не покрывает ссылки на сообщения, поэтому они тоже в ключе
+    key = ("card", _content_key(draft), draft.is_draft, draft.message_id, draft.theme_message_id)
+    return _memoize(key, build) + _expiry_line(draft) + "─" * 30
+
+
+def render_profile(user, full_name: str, username: str | None) -> str:
+    """Карточка профиля (HTML)"""
+    def build():
+        free_vacancy_line = (
+            "✅ У вас есть бесплатная публикация" if user.is_first_visit
+            else "❌ У вас нет бесплатной публикации"
+        )
+        return (
+            f"👤 <b>Твой профиль</b>\n\n"
+            f"🆔 ID: <code>{user.telegram_id}</code>\n"
+            f"💬 Имя: {full_name}\n"
+            f"🔗 Ник: @{username or '—'}\n\n"
+            f"⭐ Средний рейтинг: <b>{round(rating_average(user.rating_sum, user.rating_count), 2)}</b>\n"
+            f"📝 Отзывов получено: <b>{user.rating_count}</b>\n\n"
+            f"{free_vacancy_line}\n"
+            f"🔑 Ссылка для отзывов:\n"
+            f"<code>{BOT_LINK}?start=rate_{user.id_key}</code>"
+        )
+
+    key = (
+        "profile", user.telegram_id, full_name, username, user.is_first_visit,
+        user.id_key, user.rating_sum, user.rating_count
+    )
+    return _memoize(key, build)
@@ -0,0 +1,8 @@
+# repair_ratings.py
+import asyncio
+
+from services import rebuild_rating_stats
+
+if __name__ == "__main__":
+    updated = asyncio.run(rebuild_rating_stats())
+    print(f"Рейтинг пересчитан для {updated} пользователей")
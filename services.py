@@ -1,160 +1,550 @@
-from sqlalchemy import select, delete
-from db import async_session, Draft, User
+from sqlalchemy import select, delete, update, func, case, literal
+from types import SimpleNamespace
+from functools import partial
+from sqlalchemy.dialects.postgresql import insert
+from db import async_session, session_scope, after_commit, Draft, User, Rating
 from datetime import datetime, timezone
+import asyncio
 import hashlib
-import json
+import os
+import time
+import secrets
 from db import redis_client
+from cache import local_get, local_set, local_drop, publish_invalidation, single_flight, refresh_in_background, redis_lease, should_refresh_early
+
+HASH_SEPARATOR = "\x1f"
+
 
 def calculate_draft_hash(draft):
-    """Создает хеш из основных полей черновика для отслеживания изменений"""
-    data = {
-        "description": draft.description,
-        "contact": draft.contact,
-        "theme_name": draft.theme_name,
-        "photo": bool(draft.photo) 
-    }
-    return hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    """Создает хеш из основных полей черновика для отслеживания изменений.
+    Должен совпадать с draft_hash_expr, которым хеш считается внутри upsert"""
+    parts = [
+        draft.description or "",
+        draft.contact or "",
+        draft.theme_name or "",
+        "1" if draft.photo else "0"
+    ]
+    return hashlib.md5(HASH_SEPARATOR.join(parts).encode()).hexdigest()
+
+
+def draft_hash_expr(description, contact, theme_name, photo):
+    """SQL-версия calculate_draft_hash"""
+    return func.md5(func.concat_ws(
+        HASH_SEPARATOR,
+        func.coalesce(description, ""),
+        func.coalesce(contact, ""),
+        func.coalesce(theme_name, ""),
+        case((func.coalesce(photo, "") != "", "1"), else_="0")
+    ))
 
 # --- Пользователь ---
-async def get_user(telegram_id: int):
-    async with async_session() as session:
-        result = await session.execute(
-            select(User).where(User.telegram_id == telegram_id)
+USER_IDS_KEY = "user_ids"          # Redis-хеш telegram_id -> users.id
+USER_MISSING_TTL = 60              # Сколько помним, что пользователя нет
+
+
+def user_id_cache_key(telegram_id: int) -> str:
+    return f"uid:{telegram_id}"
+
+
+def _user_missing_key(telegram_id: int) -> str:
+    return f"uid_missing:{telegram_id}"
+
+
+async def cache_user_id(telegram_id: int, user_id: int):
+    """Запоминает соответствие telegram_id -> users.id во всех слоях кеша"""
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(USER_IDS_KEY, str(telegram_id), user_id)
+        pipe.delete(_user_missing_key(telegram_id))
+        await pipe.execute()
+    local_set(user_id_cache_key(telegram_id), user_id)
+    await publish_invalidation(user_id_cache_key(telegram_id))
+
+
+async def get_user_id(telegram_id: int, session=None):
+    """Возвращает users.id по telegram_id: сессия -> локальный кеш -> Redis-хеш -> БД.
+    Отсутствующие пользователи тоже кешируются (как 0), чтобы не ходить в БД повторно"""
+    if session is not None and telegram_id in session.info.get("user_ids", {}):
+        return session.info["user_ids"][telegram_id]
+
+    cache_key = user_id_cache_key(telegram_id)
+    user_id = local_get(cache_key)
+    if user_id is not None:
+        return user_id or None
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hget(USER_IDS_KEY, str(telegram_id))
+        pipe.exists(_user_missing_key(telegram_id))
+        cached_id, missing = await pipe.execute()
+    if cached_id is not None:
+        local_set(cache_key, int(cached_id))
+        return int(cached_id)
+    if missing:
+        local_set(cache_key, 0)
+        return None
+
+    async with session_scope(session) as s:
+        result = await s.execute(
+            select(User.id).where(User.telegram_id == telegram_id)
         )
-        return result.scalar_one_or_none()
+        user_id = result.scalar_one_or_none()
+
+    if user_id:
+        await redis_client.hset(USER_IDS_KEY, str(telegram_id), user_id)
+        local_set(cache_key, user_id)
+    else:
+        await redis_client.setex(_user_missing_key(telegram_id), USER_MISSING_TTL, 1)
+        local_set(cache_key, 0)
+    return user_id
+
+
+async def get_user(telegram_id: int, session=None):
+    user_id = await get_user_id(telegram_id, session=session)
+    if not user_id:
+        return None
+    async with session_scope(session) as s:
+        return await s.get(User, user_id)
 
 
-async def register_user(telegram_id: int, username: str | None = None):
+async def register_user(telegram_id: int, username: str | None = None, session=None):
     """Создаёт пользователя, если его нет"""
-    async with async_session() as session:
-        result = await session.execute(
+    async with session_scope(session) as s:
+        result = await s.execute(
             select(User).where(User.telegram_id == telegram_id)
         )
         user = result.scalar_one_or_none()
 
         if not user:
             user = User(telegram_id=telegram_id, username=username)
-            session.add(user)
-            await session.commit()
-            await session.refresh(user) 
-        return user
+            s.add(user)
+            await s.flush()
+            await s.refresh(user)
+        elif user.is_blocked:
+            # Пользователь вернулся - снова получает рассылки
+            user.is_blocked = False
 
+        s.info.setdefault("user_ids", {})[telegram_id] = user.id
+        after_commit(s, partial(cache_user_id, telegram_id, user.id))
+    return user
 
-async def refresh_id_key(user: User):
+
+async def refresh_id_key(user: User, session=None):
     """Обновляем ключ, если прошла неделя"""
     if not user.last_key_update or (datetime.now(timezone.utc) - user.last_key_update).days >= 7:
         user.update_id_key()
-        async with async_session() as session:
-            session.add(user)
-            await session.commit()
+        async with session_scope(session) as s:
+            s.add(user)
 
 
-# --- Черновики ---
-async def get_draft(telegram_id: int):
-    """Возвращает черновик по telegram_id пользователя с использованием кеша Redis"""
-    # Проверяем кеш
-    cache_key = f"draft:{telegram_id}"
-    cached_data = await redis_client.get(cache_key)
-    
-    if cached_data:
-        # Если данные в кеше, десериализуем и возвращаем
-        draft_dict = json.loads(cached_data)
-        # Конвертируем даты из ISO-строк обратно в datetime
-        for key in ("created_at", "published_at"):
-            value = draft_dict.get(key)
-            if isinstance(value, str):
-                try:
-                    draft_dict[key] = datetime.fromisoformat(value)
-                except Exception:
-                    draft_dict[key] = None
-        # Создаем объект Draft из словаря
-        draft = Draft()
-        for key, value in draft_dict.items():
-            setattr(draft, key, value)
-        return draft
-    
-    # Если нет в кеше, получаем из БД
-    async with async_session() as session:
-        # Получаем внутренний ID пользователя
-        result = await session.execute(
-            select(User).where(User.telegram_id == telegram_id)
+# --- Рейтинг ---
+def rating_average(rating_sum: int, rating_count: int) -> float:
+    return rating_sum / rating_count if rating_count else 0
+
+
+RATING_CACHE_TTL = 24 * 60 * 60
+
+
+def rating_cache_key(user_id: int) -> str:
+    return f"rating:{user_id}"
+
+
+async def cache_rating_totals(user_id: int, rating_sum: int, rating_count: int):
+    """Кладёт агрегаты рейтинга в Redis и локальный кеш"""
+    key = rating_cache_key(user_id)
+    await redis_client.set(key, f"{rating_sum}:{rating_count}", ex=RATING_CACHE_TTL)
+    local_set(key, (rating_sum, rating_count))
+    await publish_invalidation(key)
+
+
+async def get_rating_totals(user_id: int, session=None):
+    """Возвращает (сумма оценок, количество отзывов). Пара служит и версией рейтинга для кеша рендера"""
+    key = rating_cache_key(user_id)
+    totals = local_get(key)
+    if totals is not None:
+        return totals
+
+    raw = await redis_client.get(key)
+    if raw:
+        totals = tuple(int(x) for x in raw.decode().split(":"))
+        local_set(key, totals)
+        return totals
+
+    async with session_scope(session) as s:
+        result = await s.execute(
+            select(User.rating_sum, User.rating_count).where(User.id == user_id)
         )
-        user = result.scalar_one_or_none()
-        if not user:
+        row = result.first()
+    totals = tuple(row) if row else (0, 0)
+    await cache_rating_totals(user_id, *totals)
+    return totals
+
+
+async def get_rating_stats(user_id: int, session=None):
+    """Возвращает (средняя оценка, количество отзывов)"""
+    rating_sum, rating_count = await get_rating_totals(user_id, session=session)
+    return rating_average(rating_sum, rating_count), rating_count
+
+
+async def add_rating(from_user_id: int, to_user_id: int, score: int, session=None):
+    """Сохраняет оценку и в той же транзакции обновляет агрегаты получателя.
+    Возвращает (сумма оценок, количество отзывов) или None, если отзыв уже был"""
+    async with session_scope(session) as s:
+        result = await s.execute(
+            insert(Rating)
+            .values(from_user_id=from_user_id, to_user_id=to_user_id, score=score)
+            .on_conflict_do_nothing(constraint="unique_rating")
+            .returning(Rating.id)
+        )
+        if result.scalar_one_or_none() is None:
             return None
 
-        draft_result = await session.execute(
-            select(Draft).where(Draft.user_id == user.id)
+        # Заодно меняем ссылку для отзывов, чтобы по старой нельзя было оценить снова
+        result = await s.execute(
+            update(User)
+            .where(User.id == to_user_id)
+            .values(
+                rating_sum=User.rating_sum + score,
+                rating_count=User.rating_count + 1,
+                id_key=secrets.token_hex(8),
+                last_key_update=func.now()
+            )
+            .returning(User.rating_sum, User.rating_count)
         )
-        draft = draft_result.scalar_one_or_none()
-        
-        if draft:
-            # Сохраняем в кеш на 5 минут
-            draft_dict = {c.name: getattr(draft, c.name) for c in draft.__table__.columns}
-            # Преобразуем datetime в строки
-            for key, value in draft_dict.items():
-                if isinstance(value, datetime):
-                    draft_dict[key] = value.isoformat()
-            
-            await redis_client.setex(cache_key, 300, json.dumps(draft_dict))
-        
-        return draft
+        rating_sum, rating_count = result.one()
+        after_commit(s, partial(cache_rating_totals, to_user_id, rating_sum, rating_count))
+
+    return rating_sum, rating_count
 
-async def create_or_update_draft(telegram_id: int, **kwargs):
-    """Создаёт или обновляет черновик пользователя по telegram_id с использованием кеша Redis"""
+
+async def rebuild_rating_stats():
+    """Пересчитывает агрегаты рейтинга всех пользователей по таблице ratings"""
+    stats = (
+        select(
+            Rating.to_user_id,
+            func.sum(Rating.score).label("rating_sum"),
+            func.count(Rating.id).label("rating_count")
+        )
+        .group_by(Rating.to_user_id)
+        .subquery()
+    )
     async with async_session() as session:
-        # --- Находим пользователя ---
+        await session.execute(
+            update(User)
+            .where(User.rating_count != 0)
+            .values(rating_sum=0, rating_count=0)
+        )
         result = await session.execute(
-            select(User.id).where(User.telegram_id == telegram_id)
+            update(User)
+            .where(User.id == stats.c.to_user_id)
+            .values(rating_sum=stats.c.rating_sum, rating_count=stats.c.rating_count)
         )
-        user_id = result.scalar_one_or_none()
-        if not user_id:
-            return None
+        await session.commit()
 
-        # --- Находим или создаём черновик ---
-        result = await session.execute(
-            select(Draft).where(Draft.user_id == user_id)
+    # Локальные копии в других процессах доживут максимум LOCAL_CACHE_TTL
+    async for key in redis_client.scan_iter(match=rating_cache_key("*")):
+        await redis_client.delete(key)
+    return result.rowcount
+
+
+# --- Черновики ---
+DRAFT_CACHE_TTL = 300
+DRAFT_MISSING_TTL = 60
+# Аренда в Redis, чтобы после истечения ключа БД читал только один процесс
+DRAFT_CACHE_LEASE = os.getenv("DRAFT_CACHE_LEASE", "1") == "1"
+DRAFT_LEASE_WAIT = 1.0
+# Версия формата кеша входит в ключ: при смене формата старые ключи просто истекут
+DRAFT_CACHE_VERSION = 4
+
+# Поля черновика и их типы в кеше (даты хранятся как epoch-секунды)
+DRAFT_INT_FIELDS = ("id", "user_id", "message_id", "theme_message_id", "theme_change_count")
+DRAFT_TEXT_FIELDS = ("photo", "description", "contact", "theme_name", "payment_id", "payment_status", "last_hash")
+DRAFT_BOOL_FIELDS = ("paid", "is_draft")
+DRAFT_DATE_FIELDS = ("created_at", "published_at", "expires_at")
+
+
+class DraftView:
+    """Лёгкое read-only представление черновика без инструментирования SQLAlchemy"""
+    __slots__ = DRAFT_INT_FIELDS + DRAFT_TEXT_FIELDS + DRAFT_BOOL_FIELDS + DRAFT_DATE_FIELDS
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_mapping(cls, row):
+        return cls(**{name: row[name] for name in cls.__slots__ if name in row})
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"DraftView(id={self.id}, user_id={self.user_id}, is_draft={self.is_draft})"
+
+
+def draft_cache_key(telegram_id: int) -> str:
+    return f"draft:v{DRAFT_CACHE_VERSION}:{telegram_id}"
+
+
+def draft_generation_key(telegram_id: int) -> str:
+    return f"{draft_cache_key(telegram_id)}:gen"
+
+
+# Поколение черновика растёт при каждой записи после коммита и инвалидации.
+# Заполнение из БД и запись после коммита помнят поколение, прочитанное до запроса,
+# и пишут в кеш, только если оно не изменилось - иначе старая строка затёрла бы свежую.
+# Запись после коммита при конфликте удаляет ключ: какая из двух строк новее,
+# неизвестно, поэтому следующий get_draft прочитает БД
+DRAFT_GENERATION_TTL = 24 * 60 * 60
+
+_WRITE_DRAFT = redis_client.register_script("""
+local generation = redis.call('GET', KEYS[2]) or '0'
+if ARGV[1] ~= generation then
+    if ARGV[2] == 'write' then
+        redis.call('DEL', KEYS[1])
+        redis.call('INCR', KEYS[2])
+        redis.call('EXPIRE', KEYS[2], ARGV[4])
+    end
+    return 0
+end
+if ARGV[2] == 'write' then
+    redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[4])
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 5))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+""")
+
+
+def encode_draft(draft: DraftView) -> dict:
+    """Упаковывает черновик в поля Redis-хеша. None-значения не пишутся"""
+    fields = {}
+    for name in DRAFT_INT_FIELDS + DRAFT_TEXT_FIELDS:
+        value = getattr(draft, name)
+        if value is not None:
+            fields[name] = value
+    for name in DRAFT_BOOL_FIELDS:
+        value = getattr(draft, name)
+        if value is not None:
+            fields[name] = 1 if value else 0
+    for name in DRAFT_DATE_FIELDS:
+        value = getattr(draft, name)
+        if value is not None:
+            fields[name] = int(value.timestamp())
+    return fields
+
+
+def decode_draft(fields: dict):
+    """Обратная операция к encode_draft, принимает ответ HGETALL.
+    Для закешированного отсутствия черновика возвращает None"""
+    values = {key.decode(): value for key, value in fields.items()}
+    if "_none" in values:
+        return None
+    draft = DraftView()
+    for name in DRAFT_INT_FIELDS:
+        if name in values:
+            setattr(draft, name, int(values[name]))
+    for name in DRAFT_TEXT_FIELDS:
+        if name in values:
+            setattr(draft, name, values[name].decode())
+    for name in DRAFT_BOOL_FIELDS:
+        if name in values:
+            setattr(draft, name, values[name] == b"1")
+    for name in DRAFT_DATE_FIELDS:
+        if name in values:
+            setattr(draft, name, datetime.fromtimestamp(int(values[name]), timezone.utc))
+    return draft
+
+
+async def draft_generation(telegram_id: int) -> bytes:
+    return await redis_client.get(draft_generation_key(telegram_id)) or b"0"
+
+
+async def cache_draft(telegram_id: int, draft: DraftView | None, generation: bytes,
+                      delta: float = 0, write_through: bool = False) -> bool:
+    """Кладёт строку черновика в Redis и локальный кеш, если поколение с момента
+    чтения generation не изменилось. None кешируется как отсутствие черновика.
+    delta - сколько заняла загрузка из БД, нужна для вероятностного раннего обновления.
+    write_through=True - запись после коммита: при конфликте ключ удаляется.
+    Возвращает True, если записано"""
+    cache_key = draft_cache_key(telegram_id)
+    ttl = DRAFT_CACHE_TTL if draft is not None else DRAFT_MISSING_TTL
+    fields = encode_draft(draft) if draft is not None else {"_none": 1}
+    fields["_exp"] = time.time() + ttl
+    fields["_delta"] = delta
+    args = [generation, "write" if write_through else "fill", ttl, DRAFT_GENERATION_TTL]
+    for name, value in fields.items():
+        args += [name, value]
+    written = await _WRITE_DRAFT(keys=[cache_key, draft_generation_key(telegram_id)], args=args)
+    if written:
+        local_set(cache_key, draft if draft is not None else False)
+    elif write_through:
+        local_drop(cache_key)
+    else:
+        return False
+    await publish_invalidation(cache_key)
+    return bool(written)
+
+
+async def _write_through(session, telegram_id: int):
+    """after_commit create_or_update_draft: последняя строка черновика из сессии уходит в кеш"""
+    generation = session.info.get("draft_generations", {}).pop(telegram_id, None)
+    drafts = session.info.get("drafts", {})
+    if generation is None or telegram_id not in drafts:
+        return
+    await cache_draft(telegram_id, drafts[telegram_id], generation, write_through=True)
+
+
+async def invalidate_draft_cache(*telegram_ids: int):
+    """Убирает черновики из Redis, локального кеша и кешей других процессов"""
+    keys = [draft_cache_key(telegram_id) for telegram_id in telegram_ids]
+    if not keys:
+        return
+    local_drop(*keys)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(*keys)
+        # Заполнения из БД, начатые до инвалидации, не вернут старую строку
+        for telegram_id in telegram_ids:
+            pipe.incr(draft_generation_key(telegram_id))
+            pipe.expire(draft_generation_key(telegram_id), DRAFT_GENERATION_TTL)
+        await pipe.execute()
+    await publish_invalidation(*keys)
+
+
+async def _load_draft(telegram_id: int, session=None):
+    """Читает черновик из БД и кладёт его в кеш, если за это время его не записали заново"""
+    started = time.monotonic()
+    generation = await draft_generation(telegram_id)
+    user_id = await get_user_id(telegram_id, session=session)
+    if not user_id:
+        return None
+
+    async with session_scope(session) as s:
+        result = await s.execute(
+            select(*Draft.__table__.columns).where(Draft.user_id == user_id)
         )
-        draft = result.scalar_one_or_none()
+        row = result.mappings().one_or_none()
 
-        if not draft:
-            draft = Draft(user_id=user_id)
-            session.add(draft)
+    draft = DraftView.from_mapping(row) if row else None
+    await cache_draft(telegram_id, draft, generation, delta=time.monotonic() - started)
+    return draft
 
-        # --- Обновляем только переданные значения ---
-        for key, value in kwargs.items():
-            # чтобы не затирать поля None-ами по ошибке
-            if value is not None and hasattr(draft, key):
-                setattr(draft, key, value)
-        
-        # Вычисляем хеш для отслеживания изменений
-        draft.last_hash = calculate_draft_hash(draft)
 
-        await session.commit()
-        await session.refresh(draft)
-        
-        cache_key = f"draft:{telegram_id}"
-        await redis_client.delete(cache_key)
-        
+async def _fill_draft(telegram_id: int, session=None):
+    """Заполняет ключ черновика. Под арендой в Redis в БД идёт только один процесс,
+    остальные ждут, пока ключ появится"""
+    if not DRAFT_CACHE_LEASE:
+        return await _load_draft(telegram_id, session)
+
+    cache_key = draft_cache_key(telegram_id)
+    async with redis_lease(cache_key) as acquired:
+        if acquired:
+            return await _load_draft(telegram_id, session)
+
+    deadline = time.monotonic() + DRAFT_LEASE_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+        cached_fields = await redis_client.hgetall(cache_key)
+        if cached_fields:
+            return decode_draft(cached_fields)
+
+    # Держатель аренды не успел, читаем сами
+    return await _load_draft(telegram_id, session)
+
+
+async def get_draft(telegram_id: int, session=None):
+    """Возвращает DraftView по telegram_id пользователя: сессия -> локальный кеш -> Redis -> БД.
+    Одновременные промахи по одному пользователю идут в БД одним запросом"""
+    # Черновик, изменённый в текущей сессии, ещё не попал в кеш (запишется после коммита)
+    if session is not None and telegram_id in session.info.get("drafts", {}):
+        return session.info["drafts"][telegram_id]
+
+    cache_key = draft_cache_key(telegram_id)
+
+    cached = local_get(cache_key)
+    if cached is not None:
+        return cached or None
+
+    cached_fields = await redis_client.hgetall(cache_key)
+    if cached_fields:
+        draft = decode_draft(cached_fields)
+        local_set(cache_key, draft if draft is not None else False)
+        expires_at = float(cached_fields.get(b"_exp", 0))
+        delta = float(cached_fields.get(b"_delta", 0))
+        if should_refresh_early(expires_at, delta):
+            refresh_in_background(cache_key, partial(_fill_draft, telegram_id))
         return draft
 
-async def delete_draft(telegram_id: int):
+    # Если нет в кеше, получаем из БД
+    return await single_flight(cache_key, partial(_fill_draft, telegram_id, session))
+
+async def create_or_update_draft(telegram_id: int, session=None, **kwargs):
+    """Создаёт или обновляет черновик пользователя по telegram_id одним запросом
+    INSERT ... SELECT FROM users ... ON CONFLICT DO UPDATE ... RETURNING и пишет результат в кеш"""
+    columns = Draft.__table__.c
+    # Обновляем только переданные значения, чтобы не затирать поля None-ами по ошибке
+    fields = {
+        key: value for key, value in kwargs.items()
+        if value is not None and key in columns and key not in ("id", "user_id", "last_hash")
+    }
+
+    # Для новой строки хеш считаем сразу, для существующей - в SQL по итоговым значениям
+    new_hash = calculate_draft_hash(SimpleNamespace(
+        description=fields.get("description"),
+        contact=fields.get("contact"),
+        theme_name=fields.get("theme_name"),
+        photo=fields.get("photo")
+    ))
+    values = {**fields, "last_hash": new_hash}
+
+    source = (
+        select(User.id, *[literal(value, columns[key].type).label(key) for key, value in values.items()])
+        .where(User.telegram_id == telegram_id)
+    )
+    stmt = insert(Draft).from_select(["user_id", *values], source)
+
+    def merged(name):
+        return stmt.excluded[name] if name in fields else columns[name]
+
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[columns.user_id],
+        set_={
+            **{key: stmt.excluded[key] for key in fields},
+            "last_hash": draft_hash_expr(
+                merged("description"), merged("contact"), merged("theme_name"), merged("photo")
+            )
+        }
+    ).returning(*columns)
+
+    async with session_scope(session) as s:
+        generations = s.info.setdefault("draft_generations", {})
+        if telegram_id not in generations:
+            # После коммита пишем свежую строку в кеш, чтобы следующий get_draft не шёл в БД.
+            # Поколение читается до UPDATE: так запись узнает о любой записи или
+            # инвалидации, которая могла прийти между ними в другом порядке
+            generations[telegram_id] = await draft_generation(telegram_id)
+            after_commit(s, partial(_write_through, s, telegram_id))
+        result = await s.execute(stmt)
+        row = result.mappings().one_or_none()
+        # Пользователя нет
+        if row is None:
+            return None
+
+        draft = DraftView.from_mapping(row)
+        s.info.setdefault("drafts", {})[telegram_id] = draft
+    return draft
+
+async def delete_draft(telegram_id: int, session=None):
     """Удаляет черновик по telegram_id и инвалидирует кеш"""
-    async with async_session() as session:
-        result = await session.execute(
-            select(User).where(User.telegram_id == telegram_id)
-        )
-        user = result.scalar_one_or_none()
-        if not user:
-            return
+    user_id = await get_user_id(telegram_id, session=session)
+    if not user_id:
+        return
 
-        await session.execute(
-            delete(Draft).where(Draft.user_id == user.id)
+    async with session_scope(session) as s:
+        await s.execute(
+            delete(Draft).where(Draft.user_id == user_id)
         )
-        await session.commit()
-        
-        # Инвалидируем кеш
-        cache_key = f"draft:{telegram_id}"
-        await redis_client.delete(cache_key)
-
+        s.info.setdefault("drafts", {})[telegram_id] = None
 
+        # Инвалидируем кеш после коммита
+        after_commit(s, partial(invalidate_draft_cache, telegram_id))
@@ -1,15 +1,79 @@
+# services_payment.py
+import asyncio
+import logging
 import os
 import uuid
-from yookassa import Configuration, Payment
+
+import aiohttp
 from dotenv import load_dotenv
 
 load_dotenv()
 
-Configuration.account_id = os.getenv("YOOKASSA_SHOP_ID")
-Configuration.secret_key = os.getenv("YOOKASSA_API_KEY")
+YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
+YOOKASSA_API_KEY = os.getenv("YOOKASSA_API_KEY")
+# Можно направить на локальную заглушку API
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3").rstrip("/")
+# Жёсткий общий таймаут на запрос: медленный ответ ЮKassa не должен держать хэндлер
+PAYMENT_TIMEOUT = float(os.getenv("PAYMENT_TIMEOUT", 10))
+PAYMENT_RETRIES = int(os.getenv("PAYMENT_RETRIES", 3))
+PAYMENT_MAX_CONNECTIONS = int(os.getenv("PAYMENT_MAX_CONNECTIONS", 20))
+
+
+class PaymentError(Exception):
+    """ЮKassa ответила ошибкой или не ответила за все попытки"""
+
+
+_session = None
+
+
+def _get_session() -> aiohttp.ClientSession:
+    # Одна сессия на процесс: соединения к API переиспользуются
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            auth=aiohttp.BasicAuth(YOOKASSA_SHOP_ID or "", YOOKASSA_API_KEY or ""),
+            timeout=aiohttp.ClientTimeout(total=PAYMENT_TIMEOUT, connect=min(PAYMENT_TIMEOUT, 3)),
+            connector=aiohttp.TCPConnector(limit=PAYMENT_MAX_CONNECTIONS)
+        )
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def _request(method: str, path: str, payload: dict | None = None, idempotence_key: str | None = None) -> dict:
+    """Запрос к API с повторами. POST повторяется с тем же Idempotence-Key,
+    поэтому повтор не создаст второй платёж"""
+    headers = {"Idempotence-Key": idempotence_key} if idempotence_key else None
+    url = f"{YOOKASSA_API_URL}{path}"
+    error = None
+    for attempt in range(1, PAYMENT_RETRIES + 1):
+        delay = min(0.5 * 2 ** attempt, 5)
+        try:
+            async with _get_session().request(method, url, json=payload, headers=headers) as response:
+                data = await response.json(content_type=None) or {}
+                if response.status < 400 and response.status != 202:
+                    return data
+                error = PaymentError(f"{method} {path}: {response.status} {data.get('description', '')}".strip())
+                # 202 - запрос ещё обрабатывается, ЮKassa говорит, когда повторить
+                if response.status == 202:
+                    delay = int(data.get("retry_after", 1000)) / 1000
+                elif response.status != 429 and response.status < 500:
+                    raise error
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            error = PaymentError(f"{method} {path}: {e!r}")
+        if attempt < PAYMENT_RETRIES:
+            logging.warning(f"ЮKassa: {error}, попытка {attempt}, повтор через {delay:.1f} с.")
+            await asyncio.sleep(delay)
+    raise error
+
 
 async def create_payment(amount: float, description: str, user_id: int):
-    payment = Payment.create({
+    payment = await _request("POST", "/payments", {
         "amount": {
             "value": f"{amount:.2f}",
             "currency": "RUB"
@@ -22,7 +86,7 @@ async def create_payment(amount: float, description: str, user_id: int):
         "description": description,
         "metadata": {"user_id": user_id},
         "receipt": {
-            "customer": { 
+            "customer": {
                 "full_name": "Ivanov Ivan Ivanovich",
                 "email": "sashabobr2020@mail.ru",
                 "phone": "79316063416"
@@ -42,11 +106,13 @@ async def create_payment(amount: float, description: str, user_id: int):
             ],
             "tax_system_code": 1
         }
-    }, str(uuid.uuid4()))
+    }, idempotence_key=str(uuid.uuid4()))
+
+    logging.info(f"Создан платёж {payment['id']} для пользователя {user_id} на {amount:.2f} RUB")
+    return payment["confirmation"]["confirmation_url"], payment["id"]
 
-    return payment.confirmation.confirmation_url, payment.id
 
-def check_payment_status(payment_id: str):
-    payment = Payment.find_one(payment_id)
-    print(f"Проверка платежа {payment_id}: статус = {payment.status}")
-    return payment.status == "succeeded"
+async def get_payment_status(payment_id: str) -> str:
+    payment = await _request("GET", f"/payments/{payment_id}")
+    logging.info(f"Проверка платежа {payment_id}: статус = {payment.get('status')}")
+    return payment.get("status")
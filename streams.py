@@ -0,0 +1,243 @@
+# streams.py
+import asyncio
+import json
+import logging
+import math
+import os
+import socket
+import time
+import uuid
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from redis.exceptions import ResponseError
+
+from db import redis_client
+from metrics import STREAM_LAG
+
+# Апдейты раскладываются по партициям по from_user.id: апдейты одного пользователя
+# всегда в одном потоке и обрабатываются строго по очереди одним воркером
+UPDATE_STREAM = "updates"
+UPDATE_GROUP = "bot-workers"
+UPDATE_PARTITIONS = int(os.getenv("UPDATE_PARTITIONS", 16))
+UPDATE_STREAM_MAXLEN = int(os.getenv("UPDATE_STREAM_MAXLEN", 100000))
+DEAD_LETTER_STREAM = f"{UPDATE_STREAM}:dead"
+
+# Партиция закреплена за воркером арендой в Redis; если воркер упал, аренда истекает
+PARTITION_LEASE_MS = int(os.getenv("PARTITION_LEASE_MS", 15000))
+# Апдейт, который обрабатывается дольше, уходит в dead letter. Чужие неподтверждённые
+# апдейты забираются только после этого срока, поэтому у живого воркера их не отнимут
+UPDATE_HANDLER_TIMEOUT = float(os.getenv("UPDATE_HANDLER_TIMEOUT", 60))
+UPDATE_CLAIM_IDLE_MS = int((UPDATE_HANDLER_TIMEOUT + 5) * 1000)
+LAG_REPORT_INTERVAL = int(os.getenv("LAG_REPORT_INTERVAL", 60))
+
+_RENEW_LEASE = redis_client.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+)
+_RELEASE_LEASE = redis_client.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+)
+
+
+def partition_stream(partition: int) -> str:
+    return f"{UPDATE_STREAM}:{partition}"
+
+
+def partition_for(update: Update) -> int:
+    try:
+        user = getattr(update.event, "from_user", None)
+    except Exception:
+        user = None
+    return user.id % UPDATE_PARTITIONS if user else 0
+
+
+async def publish_update(update: Update):
+    """Кладёт сырой апдейт в поток его партиции"""
+    await redis_client.xadd(
+        partition_stream(partition_for(update)),
+        {"update": update.model_dump_json(exclude_unset=True, by_alias=True)},
+        maxlen=UPDATE_STREAM_MAXLEN,
+        approximate=True
+    )
+
+
+class StreamIngestMiddleware(BaseMiddleware):
+    """Режим UPDATE_MODE=stream: процесс с polling/webhook только складывает апдейты
+    в Redis Streams, хэндлеры выполняют процессы bot_worker.py"""
+
+    async def __call__(self, handler, event, data):
+        await publish_update(event)
+
+
+async def ensure_groups():
+    for partition in range(UPDATE_PARTITIONS):
+        try:
+            await redis_client.xgroup_create(partition_stream(partition), UPDATE_GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+
+async def stream_lag() -> dict:
+    """{партиция: (lag, pending)} - сколько апдейтов ещё не прочитано и сколько не подтверждено"""
+    lag = {}
+    for partition in range(UPDATE_PARTITIONS):
+        for group in await redis_client.xinfo_groups(partition_stream(partition)):
+            name = group["name"]
+            if (name.decode() if isinstance(name, bytes) else name) == UPDATE_GROUP:
+                lag[partition] = (group.get("lag") or 0, group.get("pending") or 0)
+    return lag
+
+
+class UpdateConsumer:
+    """Читает апдейты своих партиций через consumer group и передаёт их в диспетчер.
+    Партиции делятся между живыми воркерами поровну; апдейты, которые упавший
+    воркер получил, но не подтвердил, забираются через XAUTOCLAIM"""
+
+    def __init__(self, dp, bot, batch: int = 50):
+        self.dp = dp
+        self.bot = bot
+        self.batch = batch
+        self.name = f"{socket.gethostname()}-{uuid.uuid4().hex[:6]}"
+        self._tasks = {}        # {партиция: задача чтения}
+        self._stops = {}        # {партиция: Event - дочитать текущий апдейт и остановиться}
+        self._draining = {}     # {партиция: задача, которая ждёт остановки и отдаёт аренду}
+
+    def _lease_key(self, partition: int) -> str:
+        return f"{partition_stream(partition)}:lease"
+
+    async def run(self):
+        await ensure_groups()
+        self._lag_task = asyncio.create_task(self._report_lag())
+        logging.info(f"Воркер {self.name} читает группу {UPDATE_GROUP}")
+        try:
+            while True:
+                await self._rebalance()
+                await asyncio.sleep(PARTITION_LEASE_MS / 3000)
+        finally:
+            for partition in list(self._tasks):
+                self._release(partition)
+            await asyncio.gather(*self._draining.values(), return_exceptions=True)
+
+    async def _rebalance(self):
+        now = time.time()
+        heartbeat = f"{UPDATE_STREAM}:workers"
+        await redis_client.zadd(heartbeat, {self.name: now})
+        await redis_client.zremrangebyscore(heartbeat, 0, now - PARTITION_LEASE_MS / 1000)
+        workers = max(1, await redis_client.zcard(heartbeat))
+        target = math.ceil(UPDATE_PARTITIONS / workers)
+
+        # Пока партиция дочитывает текущий апдейт, аренда остаётся за нами
+        for partition in list(self._draining):
+            await _RENEW_LEASE(keys=[self._lease_key(partition)], args=[self.name, PARTITION_LEASE_MS])
+
+        for partition, task in list(self._tasks.items()):
+            renewed = await _RENEW_LEASE(keys=[self._lease_key(partition)], args=[self.name, PARTITION_LEASE_MS])
+            if not renewed or task.done():
+                self._release(partition)
+
+        # Отдаём лишнее, если пришли новые воркеры
+        while len(self._tasks) > target:
+            self._release(max(self._tasks))
+
+        for partition in range(UPDATE_PARTITIONS):
+            if len(self._tasks) >= target:
+                break
+            if partition in self._tasks or partition in self._draining:
+                continue
+            if await redis_client.set(self._lease_key(partition), self.name, nx=True, px=PARTITION_LEASE_MS):
+                self._stops[partition] = asyncio.Event()
+                self._tasks[partition] = asyncio.create_task(self._consume(partition, self._stops[partition]))
+
+    def _release(self, partition: int):
+        """Просит партицию остановиться. Аренда отдаётся в фоне, когда текущий апдейт
+        обработан и подтверждён - иначе новый владелец выполнил бы его второй раз"""
+        task = self._tasks.pop(partition, None)
+        self._stops.pop(partition, asyncio.Event()).set()
+        self._draining[partition] = asyncio.create_task(self._drain(partition, task))
+
+    async def _drain(self, partition: int, task):
+        try:
+            if task:
+                await asyncio.gather(task, return_exceptions=True)
+            await _RELEASE_LEASE(keys=[self._lease_key(partition)], args=[self.name])
+        except Exception as e:
+            logging.warning(f"Не удалось отдать партицию {partition}: {e}")
+        finally:
+            self._draining.pop(partition, None)
+
+    async def _consume(self, partition: int, stop: asyncio.Event):
+        stream = partition_stream(partition)
+
+        # Сначала то, что получил и не подтвердил прежний владелец партиции.
+        # Новые апдейты читаем только после его хвоста, иначе нарушится порядок
+        start = "0-0"
+        while not stop.is_set():
+            start, entries, _ = await redis_client.xautoclaim(
+                stream, UPDATE_GROUP, self.name, min_idle_time=UPDATE_CLAIM_IDLE_MS,
+                start_id=start, count=self.batch
+            )
+            if not await self._handle_batch(stream, entries, stop):
+                return
+            if start in (b"0-0", "0-0"):
+                if not (await redis_client.xpending(stream, UPDATE_GROUP))["pending"]:
+                    break
+                # Прежний владелец ещё обрабатывает свои апдейты или упал и они не простояли
+                # UPDATE_CLAIM_IDLE_MS - ждём
+                await asyncio.sleep(1)
+
+        while not stop.is_set():
+            response = await redis_client.xreadgroup(
+                UPDATE_GROUP, self.name, {stream: ">"}, count=self.batch, block=5000
+            )
+            for _, entries in response:
+                if not await self._handle_batch(stream, entries, stop):
+                    return
+
+    async def _handle_batch(self, stream: str, entries, stop: asyncio.Event) -> bool:
+        """Обрабатывает пачку по порядку. При остановке необработанный остаток сразу
+        отдаётся следующему владельцу. Возвращает False, если пачка не дочитана"""
+        for i, (entry_id, fields) in enumerate(entries):
+            if stop.is_set():
+                await redis_client.xclaim(
+                    stream, UPDATE_GROUP, self.name, min_idle_time=0,
+                    message_ids=[entry_id for entry_id, _ in entries[i:]],
+                    idle=UPDATE_CLAIM_IDLE_MS, justid=True
+                )
+                return False
+            if not fields:
+                # Запись удалена из потока по MAXLEN, пока была неподтверждённой
+                await redis_client.xack(stream, UPDATE_GROUP, entry_id)
+                continue
+            await self._handle(stream, entry_id, fields)
+        return True
+
+    async def _handle(self, stream: str, entry_id, fields: dict):
+        try:
+            data = json.loads(fields[b"update"])
+            update = Update.model_validate(data, context={"bot": self.bot})
+            await asyncio.wait_for(self.dp.feed_update(self.bot, update), UPDATE_HANDLER_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Не блокируем партицию: апдейт уходит в dead letter для разбора
+            logging.error(f"Ошибка обработки апдейта {entry_id} из {stream}: {e!r}")
+            await redis_client.xadd(DEAD_LETTER_STREAM, {**fields, "error": repr(e)},
+                                    maxlen=UPDATE_STREAM_MAXLEN, approximate=True)
+        await redis_client.xack(stream, UPDATE_GROUP, entry_id)
+
+    async def _report_lag(self):
+        while True:
+            await asyncio.sleep(LAG_REPORT_INTERVAL)
+            try:
+                lag = await stream_lag()
+                total_lag = sum(l for l, _ in lag.values())
+                total_pending = sum(p for _, p in lag.values())
+                STREAM_LAG.labels("lag").set(total_lag)
+                STREAM_LAG.labels("pending").set(total_pending)
+                logging.info(
+                    f"Потоки апдейтов: lag={total_lag}, pending={total_pending}, "
+                    f"партиций у {self.name}: {sorted(self._tasks)}"
+                )
+            except Exception as e:
+                logging.warning(f"Не удалось получить lag потоков: {e}")
@@ -1,68 +1,197 @@
-# В tasks.py заменить функцию check_expired_posts:
-from telegram_utils import safe_delete_message
-from db import async_session, User, Draft
-from sqlalchemy import update
-from db import redis_client
-from datetime import datetime, timedelta, timezone
+# tasks.py
+from db import async_session, redis_client, User, Draft
+from sqlalchemy import update, select, and_
+from services import invalidate_draft_cache
+from outbound import outbound, post_editor
+from jobs import job, enqueue
+from functools import partial
+from datetime import datetime, timezone
 import logging
 import asyncio
+import time
 from dotenv import load_dotenv
 import os
-from sqlalchemy import select
 
 load_dotenv()
 CHAT_ID = int(os.getenv("CHAT_ID"))
 
+EXPIRY_CHUNK = int(os.getenv("EXPIRY_CHUNK", 500))
+
+
+async def _delete_messages(bot, message_ids):
+    """Удаляет сообщения через диспетчер отправки: параллельно, но в рамках общего rate limiter"""
+    futures = []
+    for message_id in message_ids:
+        post_editor.cancel(CHAT_ID, message_id)
+        futures.append(await outbound.submit(
+            partial(bot.delete_message, chat_id=CHAT_ID, message_id=message_id),
+            key=(CHAT_ID, message_id)
+        ))
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    return sum(
+        1 for r in results
+        if isinstance(r, Exception) and "message to delete not found" not in str(r)
+    )
+
+
+async def _expire(bot, condition):
+    """Снимает с публикации черновики по condition одним UPDATE ... RETURNING
+    и убирает за ними кеш и сообщения. Возвращает (строки, неудачные удаления)"""
+    async with async_session() as session:
+        # telegram_id приходит тем же запросом - не нужно искать пользователя для каждого поста
+        result = await session.execute(
+            update(Draft)
+            .where(condition, User.id == Draft.user_id)
+            .values(is_draft=True, paid=False, published_at=None, expires_at=None)
+            .returning(Draft.id, Draft.message_id, Draft.theme_message_id, User.telegram_id)
+        )
+        rows = result.all()
+        await session.commit()
+
+    if not rows:
+        return rows, 0
+    await invalidate_draft_cache(*(row.telegram_id for row in rows))
+    message_ids = [
+        message_id
+        for row in rows
+        for message_id in (row.message_id, row.theme_message_id)
+        if message_id
+    ]
+    return rows, await _delete_messages(bot, message_ids)
+
+
+def _expired(now):
+    # Условие совпадает с предикатом частичного индекса ix_drafts_expires_at
+    return and_(
+        Draft.is_draft == False,
+        Draft.expires_at <= now
+    )
+
+
+async def expire_posts(bot, chunk_size: int = EXPIRY_CHUNK):
+    """Полный проход: возвращает просроченные публикации в черновики пачками по chunk_size.
+    Возвращает (сколько публикаций снято, сколько секунд заняло)"""
+    started = time.monotonic()
+    now = datetime.now(timezone.utc)
+    total = 0
+    failed = 0
+
+    while True:
+        # Снятые посты уходят из частичного индекса, поэтому каждая пачка
+        # берётся с его начала: память ограничена размером пачки
+        chunk = (
+            select(Draft.id)
+            .where(_expired(now))
+            .order_by(Draft.expires_at)
+            .limit(chunk_size)
+            .scalar_subquery()
+        )
+        rows, chunk_failed = await _expire(bot, Draft.id.in_(chunk))
+        if not rows:
+            break
+        total += len(rows)
+        failed += chunk_failed
+        if len(rows) < chunk_size:
+            break
+
+    duration = time.monotonic() - started
+    if total:
+        logging.info(
+            f"Снято просроченных публикаций: {total} за {duration:.1f} с."
+            + (f", не удалось удалить сообщений: {failed}" if failed else "")
+        )
+    return total, duration
+
+
+# --- Точное расписание через Redis ZSET ---
+# Участник - id черновика, score - время окончания публикации (epoch).
+# Истина всё равно в БД: ZSET лишь говорит, когда проверить, а потерянные записи
+# подбирает периодический полный проход
+EXPIRY_ZSET = "post_expiry"
+EXPIRY_POLL_INTERVAL = int(os.getenv("EXPIRY_POLL_INTERVAL", 5))
+EXPIRY_SWEEP_INTERVAL = int(os.getenv("EXPIRY_SWEEP_INTERVAL", 60 * 60))
+EXPIRY_RETRY_DELAY = int(os.getenv("EXPIRY_RETRY_DELAY", 30))
+
+# Забирает до ARGV[2] наступивших записей, чтобы их не взял второй процесс
+_CLAIM_DUE = redis_client.register_script("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return due
+""")
+
+
+async def schedule_expiry(draft_id: int, expires_at: datetime):
+    """Ставит снятие публикации в ZSET на drafts.expires_at"""
+    await redis_client.zadd(EXPIRY_ZSET, {draft_id: expires_at.timestamp()})
+
+
+async def cancel_expiry(draft_id: int):
+    await redis_client.zrem(EXPIRY_ZSET, draft_id)
+
+
+async def expire_due(bot, limit: int = EXPIRY_CHUNK):
+    """Снимает публикации, чьё время в ZSET наступило. Возвращает их количество"""
+    due = await _CLAIM_DUE(keys=[EXPIRY_ZSET], args=[time.time(), limit])
+    if not due:
+        return 0
+    ids = [int(draft_id) for draft_id in due]
+    try:
+        # Черновик мог уже уйти в черновики или быть опубликован заново - это решает БД
+        rows, _ = await _expire(bot, and_(Draft.id.in_(ids), _expired(datetime.now(timezone.utc))))
+    except Exception:
+        # Забранные записи возвращаются в ZSET, иначе они ждали бы полного прохода.
+        # NX: новое расписание, поставленное за это время, не перезаписывается
+        await redis_client.zadd(EXPIRY_ZSET, {draft_id: time.time() + EXPIRY_RETRY_DELAY for draft_id in ids}, nx=True)
+        raise
+    if rows:
+        logging.info(f"Снято публикаций по расписанию: {len(rows)}")
+    return len(rows)
+
+
+async def reseed_expiry(chunk_size: int = EXPIRY_CHUNK):
+    """Заново кладёт в ZSET все текущие публикации (после потери Redis или первого запуска)"""
+    last_id = 0
+    while True:
+        async with async_session() as session:
+            result = await session.execute(
+                select(Draft.id, Draft.expires_at)
+                .where(Draft.id > last_id, Draft.is_draft == False, Draft.expires_at != None)
+                .order_by(Draft.id)
+                .limit(chunk_size)
+            )
+            rows = result.all()
+        if not rows:
+            return
+        await redis_client.zadd(EXPIRY_ZSET, {
+            row.id: row.expires_at.timestamp() for row in rows
+        })
+        last_id = rows[-1].id
+
+
+@job("expire_sweep", max_retries=3)
+async def job_expire_sweep(bot):
+    """Полный проход по БД и пересборка ZSET"""
+    await expire_posts(bot)
+    await reseed_expiry()
+
+
 async def check_expired_posts(bot):
+    """Раз в EXPIRY_POLL_INTERVAL секунд снимает наступившие по ZSET публикации,
+    раз в EXPIRY_SWEEP_INTERVAL ставит в очередь полный проход"""
+    next_sweep = 0
     while True:
         try:
-            async with async_session() as session:
-                # Получаем все просроченные черновики
-                now = datetime.now(timezone.utc)
-                result = await session.execute(
-                    select(Draft).where(
-                        Draft.is_draft == False,
-                        Draft.published_at != None,
-                        Draft.published_at + timedelta(days=30) <= now
-                    )
-                )
-                expired_drafts = result.scalars().all()
-                
-                # Собираем ID для bulk-update
-                expired_ids = [draft.id for draft in expired_drafts]
-                
-                if expired_ids:
-                    # Выполняем bulk-update
-                    await session.execute(
-                        update(Draft)
-                        .where(Draft.id.in_(expired_ids))
-                        .values(is_draft=True, paid=False, published_at=None)
-                    )
-                    await session.commit()
-                    
-                    # Удаляем сообщения с ограничением скорости
-                    for draft in expired_drafts:
-                        if draft.message_id:
-                            await safe_delete_message(bot, CHAT_ID, draft.message_id)
-                            if draft.theme_message_id:
-                                await safe_delete_message(bot, CHAT_ID, draft.theme_message_id)
-                            # Ограничиваем скорость удаления (не более 20 сообщений в секунду)
-                            await asyncio.sleep(0.05)
-                        
-                        logging.info(f"Резюме пользователя {draft.user_id} возвращено в черновик")
-                        
-                        # Инвалидируем кеш для этого пользователя
-                        user_result = await session.execute(
-                            select(User.telegram_id).where(User.id == draft.user_id)
-                        )
-                        telegram_id = user_result.scalar_one_or_none()
-                        if telegram_id:
-                            cache_key = f"draft:{telegram_id}"
-                            await redis_client.delete(cache_key)
-                
-            # Проверяем каждые 12 часов
-            await asyncio.sleep(12*60*60)
+            if time.monotonic() >= next_sweep:
+                # Ключ общий для окна, поэтому при нескольких воркерах проход будет один
+                window = int(time.time() // EXPIRY_SWEEP_INTERVAL)
+                await enqueue("expire_sweep", key=f"expire_sweep:{window}")
+                next_sweep = time.monotonic() + EXPIRY_SWEEP_INTERVAL
+            while await expire_due(bot) > 0:
+                pass
+            await asyncio.sleep(EXPIRY_POLL_INTERVAL)
         except Exception as e:
             logging.error(f"Ошибка при проверке просроченных постов: {e}")
-            # В случае ошибки ждем 5 минут и пробуем снова
-            await asyncio.sleep(5*60)
\ No newline at end of file
+            # В случае ошибки ждем минуту и пробуем снова
+            await asyncio.sleep(60)
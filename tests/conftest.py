@@ -0,0 +1,16 @@
+# conftest.py
+import os
+import sys
+
+# Модули бота читают настройки из окружения при импорте. Соединения с Redis и БД
+# открываются лениво, поэтому для тестов без них хватает заглушек
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("CHAT_ID", "-100")
+os.environ.setdefault("REDIS_HOST", "localhost")
+os.environ.setdefault("REDIS_PORT", "6379")
+os.environ.setdefault("DB_USER", "test")
+os.environ.setdefault("DB_PASSWORD", "test")
+os.environ.setdefault("DB_HOST", "localhost")
+os.environ.setdefault("DB_NAME", "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
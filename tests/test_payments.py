@@ -0,0 +1,149 @@
+# test_payments.py
+import asyncio
+import ipaddress
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from sqlalchemy import create_engine, insert, select, update
+
+import payments
+from db import Base, Draft, User
+from payments import PAYMENT_WEBHOOK_PATH, apply_payment_status, setup_payment_routes, _status_transition
+
+NOTIFICATION = {"type": "notification", "event": "payment.succeeded", "object": {"id": "p1", "status": "succeeded"}}
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """Статус из API и запись в БД подменены - проверяется только обработка уведомления"""
+    applied = []
+
+    async def get_payment_status(payment_id):
+        if payment_id == "broken":
+            raise payments.PaymentError("недоступно")
+        return "succeeded"
+
+    async def apply(bot, payment_id, status):
+        applied.append((payment_id, status))
+        return True
+
+    monkeypatch.setattr(payments, "get_payment_status", get_payment_status)
+    monkeypatch.setattr(payments, "apply_payment_status", apply)
+    return applied
+
+
+def notify(monkeypatch, allowed: str, **request) -> int:
+    monkeypatch.setattr(payments, "_allowed_networks", [ipaddress.ip_network(allowed)])
+
+    async def main():
+        app = web.Application()
+        setup_payment_routes(app, bot=None)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post(PAYMENT_WEBHOOK_PATH, **request)
+            return response.status
+
+    return asyncio.run(main())
+
+
+def test_foreign_address_rejected(monkeypatch, api):
+    assert notify(monkeypatch, "185.71.76.0/27", json=NOTIFICATION) == 403
+    assert api == []
+
+
+@pytest.mark.parametrize("request_body", [
+    {"data": "не json"},
+    {"json": {"event": "payment.succeeded"}},
+    {"json": {"object": None}},
+])
+def test_bad_body_rejected(monkeypatch, api, request_body):
+    assert notify(monkeypatch, "127.0.0.1/32", **request_body) == 400
+    assert api == []
+
+
+def test_status_taken_from_api(monkeypatch, api):
+    body = {**NOTIFICATION, "object": {"id": "p1", "status": "canceled"}}
+    assert notify(monkeypatch, "127.0.0.1/32", json=body) == 200
+    # В теле canceled, но тело не подписано - записывается статус из API
+    assert api == [("p1", "succeeded")]
+
+
+def test_api_error_asks_for_redelivery(monkeypatch, api):
+    body = {**NOTIFICATION, "object": {"id": "broken"}}
+    assert notify(monkeypatch, "127.0.0.1/32", json=body) == 500
+    assert api == []
+
+
+def test_status_transition():
+    """Условия перехода на настоящей таблице: повтор и выход из финального статуса ничего не меняют"""
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine, tables=[User.__table__, Draft.__table__])
+    with engine.begin() as conn:
+        conn.execute(insert(User).values(id=1, telegram_id=42))
+        conn.execute(insert(Draft).values(id=1, user_id=1, payment_id="p1"))
+
+        changed = []
+        for status in ("pending", "pending", "waiting_for_capture", "succeeded", "succeeded", "canceled", "pending"):
+            result = conn.execute(
+                update(Draft)
+                .where(Draft.payment_id == "p1", *_status_transition(status))
+                .values(payment_status=status)
+            )
+            changed.append(result.rowcount)
+        final = conn.execute(select(Draft.payment_status)).scalar()
+
+    assert changed == [1, 0, 1, 1, 0, 0, 0]
+    assert final == "succeeded"
+
+
+class FakeSession:
+    """async_session(), у которого UPDATE ... RETURNING вернёт telegram_ids"""
+
+    def __init__(self, telegram_ids):
+        self.telegram_ids = telegram_ids
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, statement):
+        telegram_ids = self.telegram_ids
+
+        class Result:
+            def scalars(self):
+                return self
+
+            def all(self):
+                return telegram_ids
+
+        return Result()
+
+    async def commit(self):
+        pass
+
+
+@pytest.mark.parametrize("telegram_ids, expected", [([42], True), ([], False)])
+def test_apply_side_effects_only_on_change(monkeypatch, telegram_ids, expected):
+    invalidated, sent = [], []
+
+    async def invalidate(*ids):
+        invalidated.extend(ids)
+
+    async def submit(call, lane=None):
+        sent.append(call.keywords["chat_id"])
+
+    monkeypatch.setattr(payments, "async_session", FakeSession(telegram_ids))
+    monkeypatch.setattr(payments, "invalidate_draft_cache", invalidate)
+    monkeypatch.setattr(payments.outbound, "submit", submit)
+
+    bot = SimpleNamespace(send_message=lambda **kwargs: None)
+    assert asyncio.run(apply_payment_status(bot, "p1", "succeeded")) is expected
+    # Повторное уведомление не пересоздаёт кеш и не пишет пользователю второй раз
+    assert invalidated == telegram_ids
+    assert sent == telegram_ids
@@ -0,0 +1,102 @@
+# test_services_payment.py
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import services_payment
+from services_payment import create_payment, get_payment_status, close_session, PaymentError
+
+PAYMENT = {"id": "p1", "status": "pending", "confirmation": {"confirmation_url": "https://pay"}}
+
+
+class FakeYooKassa:
+    """Заглушка API: по очереди отдаёт ответы (статус, тело), последний повторяется.
+    Статус None - зависнуть на тело секунд"""
+
+    def __init__(self, *responses):
+        self.responses = responses
+        self.requests = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests.append(request)
+        status, body = self.responses[min(len(self.requests), len(self.responses)) - 1]
+        if status is None:
+            await asyncio.sleep(body)
+            status, body = 200, PAYMENT
+        return web.json_response(body, status=status)
+
+
+def call(monkeypatch, fake: FakeYooKassa, request, retries: int = 2):
+    """Выполняет request() с клиентом, направленным на заглушку через YOOKASSA_API_URL"""
+    async def main():
+        app = web.Application()
+        app.router.add_route("*", "/v3/{tail:.*}", fake.handle)
+        server = TestServer(app)
+        await server.start_server()
+        monkeypatch.setattr(services_payment, "YOOKASSA_API_URL", str(server.make_url("/v3")))
+        try:
+            return await request()
+        finally:
+            await close_session()
+            await server.close()
+
+    monkeypatch.setattr(services_payment, "PAYMENT_TIMEOUT", 0.3)
+    monkeypatch.setattr(services_payment, "PAYMENT_RETRIES", retries)
+    return asyncio.run(main())
+
+
+def test_create_payment_retried_with_same_idempotence_key(monkeypatch):
+    fake = FakeYooKassa((500, {"description": "internal"}), (200, PAYMENT))
+    result = call(monkeypatch, fake, lambda: create_payment(100, "Публикация", 42))
+
+    assert result == ("https://pay", "p1")
+    assert len(fake.requests) == 2
+    keys = [r.headers.get("Idempotence-Key") for r in fake.requests]
+    assert keys[0] and keys[0] == keys[1]
+
+
+def test_each_payment_gets_own_idempotence_key(monkeypatch):
+    fake = FakeYooKassa((200, PAYMENT))
+
+    async def two_payments():
+        await create_payment(100, "Публикация", 42)
+        await create_payment(100, "Публикация", 42)
+
+    call(monkeypatch, fake, two_payments)
+    keys = {r.headers.get("Idempotence-Key") for r in fake.requests}
+    assert len(keys) == 2
+
+
+def test_client_error_not_retried(monkeypatch):
+    fake = FakeYooKassa((404, {"description": "not found"}))
+    with pytest.raises(PaymentError, match="404 not found"):
+        call(monkeypatch, fake, lambda: get_payment_status("missing"))
+    assert len(fake.requests) == 1
+
+
+def test_rate_limit_retried(monkeypatch):
+    fake = FakeYooKassa((429, {"description": "too many requests"}), (200, {"id": "p1", "status": "succeeded"}))
+    assert call(monkeypatch, fake, lambda: get_payment_status("p1")) == "succeeded"
+    assert len(fake.requests) == 2
+
+
+def test_processing_retried_after_retry_after(monkeypatch):
+    fake = FakeYooKassa((202, {"retry_after": 10}), (200, {"id": "p1", "status": "waiting_for_capture"}))
+    assert call(monkeypatch, fake, lambda: get_payment_status("p1")) == "waiting_for_capture"
+    assert len(fake.requests) == 2
+
+
+def test_server_errors_exhaust_retries(monkeypatch):
+    fake = FakeYooKassa((503, {"description": "unavailable"}))
+    with pytest.raises(PaymentError, match="503"):
+        call(monkeypatch, fake, lambda: get_payment_status("p1"), retries=2)
+    assert len(fake.requests) == 2
+
+
+def test_timeout_retried_then_fails(monkeypatch):
+    fake = FakeYooKassa((None, 1))
+    with pytest.raises(PaymentError, match="TimeoutError"):
+        call(monkeypatch, fake, lambda: get_payment_status("p1"), retries=2)
+    assert len(fake.requests) == 2
@@ -0,0 +1,119 @@
+# test_webhook.py
+import asyncio
+import json
+
+from aiogram import Bot, Dispatcher
+from aiohttp.test_utils import TestClient, TestServer
+
+from webhook import create_webhook_app, WEBHOOK_PATH, WEBHOOK_SECRET
+
+UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 10,
+        "date": 0,
+        "chat": {"id": 42, "type": "private"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Test"},
+        "text": "привет"
+    }
+}
+
+
+async def post_update(secret: str | None):
+    """Шлёт апдейт на вебхук как Telegram. Возвращает статус ответа и полученные хэндлером тексты"""
+    dp = Dispatcher()
+    bot = Bot(token="1:test")
+    received = asyncio.Queue()
+
+    @dp.message()
+    async def echo(message):
+        await received.put(message.text)
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    async with TestClient(TestServer(create_webhook_app(dp, bot))) as client:
+        response = await client.post(WEBHOOK_PATH, json=UPDATE, headers=headers)
+        texts = []
+        if response.status == 200:
+            # Апдейт обрабатывается в фоне уже после ответа
+            texts.append(await asyncio.wait_for(received.get(), timeout=2))
+        await asyncio.sleep(0)
+        texts += [received.get_nowait() for _ in range(received.qsize())]
+    await bot.session.close()
+    return response.status, texts
+
+
+def test_wrong_secret_rejected():
+    status, texts = asyncio.run(post_update("wrong"))
+    assert status == 401
+    assert texts == []
+
+
+def test_missing_secret_rejected():
+    status, texts = asyncio.run(post_update(None))
+    assert status == 401
+    assert texts == []
+
+
+def test_update_dispatched():
+    status, texts = asyncio.run(post_update(WEBHOOK_SECRET))
+    assert status == 200
+    assert texts == ["привет"]
+
+
+def test_run_webhook_registers_with_bot_api(monkeypatch):
+    """run_webhook против заглушки Bot API: сервер поднят и setWebhook получил все параметры"""
+    import webhook
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiohttp import ClientSession, web
+    from aiohttp.test_utils import unused_port
+
+    calls = asyncio.Queue()
+
+    async def bot_api(request):
+        await calls.put((request.match_info["method"], dict(await request.post())))
+        return web.json_response({"ok": True, "result": True})
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", bot_api)
+        api = TestServer(app)
+        await api.start_server()
+
+        port = unused_port()
+        monkeypatch.setattr(webhook, "WEBHOOK_URL", "https://bot.example.com/")
+        monkeypatch.setattr(webhook, "WEBHOOK_HOST", "127.0.0.1")
+        monkeypatch.setattr(webhook, "WEBHOOK_PORT", port)
+
+        dp = Dispatcher()
+        received = asyncio.Queue()
+
+        @dp.message()
+        async def echo(message):
+            await received.put(message.text)
+
+        bot = Bot(token="1:test", session=AiohttpSession(api=TelegramAPIServer.from_base(str(api.make_url("")))))
+        server = asyncio.create_task(webhook.run_webhook(dp, bot))
+        try:
+            method, params = await asyncio.wait_for(calls.get(), timeout=5)
+            # Сервер уже слушает порт: апдейт с секретом доходит до хэндлера
+            async with ClientSession() as client:
+                response = await client.post(
+                    f"http://127.0.0.1:{port}{WEBHOOK_PATH}", json=UPDATE,
+                    headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+                )
+            text = await asyncio.wait_for(received.get(), timeout=2)
+        finally:
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+            await bot.session.close()
+            await api.close()
+        return method, params, response.status, text
+
+    method, params, status, text = asyncio.run(main())
+    assert method == "setWebhook"
+    assert params["url"] == "https://bot.example.com" + WEBHOOK_PATH
+    assert params["secret_token"] == WEBHOOK_SECRET
+    assert params["max_connections"] == str(webhook.WEBHOOK_MAX_CONNECTIONS)
+    assert json.loads(params["allowed_updates"]) == ["message"]
+    assert (status, text) == (200, "привет")
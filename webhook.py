@@ -0,0 +1,65 @@
+# webhook.py
+import asyncio
+import hashlib
+import logging
+import os
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from dotenv import load_dotenv
+
+from payments import setup_payment_routes
+
+load_dotenv()
+
+# Публичный https-адрес, на который Telegram шлёт апдейты, например https://bot.example.com
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+# Сколько одновременных соединений Telegram держит с сервером (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+# Telegram присылает его в X-Telegram-Bot-Api-Secret-Token. Без явного значения
+# берём производное от токена, чтобы у всех реплик секрет был одинаковым
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(os.getenv("BOT_TOKEN", "").encode()).hexdigest()
+
+
+def create_webhook_app(dp, bot) -> web.Application:
+    """aiohttp-приложение: апдейт проверяется по секрету, Telegram сразу получает 200,
+    а обработка идёт в фоне в диспетчере"""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    # Уведомления ЮKassa принимает тот же сервер
+    setup_payment_routes(app, bot)
+    return app
+
+
+async def run_webhook(dp, bot):
+    """Запускает веб-сервер и регистрирует вебхук в Telegram"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для BOT_MODE=webhook нужен WEBHOOK_URL")
+
+    runner = web.AppRunner(create_webhook_app(dp, bot))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+
+    url = WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+    await bot.set_webhook(
+        url=url,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logging.info(f"Вебхук {url} слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()